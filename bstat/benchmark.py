@@ -0,0 +1,116 @@
+######################################################################
+#
+# File: benchmark.py
+#
+# Copyright 2013 Brian Beach, All Rights Reserved.
+#
+######################################################################
+
+"""
+Benchmarks for the things that need to stay fast.  Run this module
+to print the numbers:
+
+    python -m bstat.benchmark
+
+The tests at the bottom guard against regressions.  The ones that
+check timings are flaky on a busy machine, so they only run when the
+BSTAT_TIMING_TESTS environment variable is set.
+"""
+
+import os
+import StringIO
+import subprocess
+import sys
+import time
+import unittest
+
+from .data import read_csv
+
+timing_test = unittest.skipUnless(
+    os.environ.get('BSTAT_TIMING_TESTS'),
+    'set BSTAT_TIMING_TESTS to run timing tests'
+    )
+
+# Modules that are too slow to import every time bstat is imported.
+HEAVY_MODULES = ['numpy', 'scipy']
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import bstat
+elapsed = time.time() - start
+heavy = [name for name in %r if name in sys.modules]
+print('%%f %%s' %% (elapsed, ','.join(heavy)))
+''' % (HEAVY_MODULES,)
+
+def measure_import_time():
+    """
+    Imports bstat in a fresh interpreter.  Returns the time it took,
+    in seconds, and the list of heavy modules that got imported along
+    with it.
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT])
+    fields = output.decode('ascii').split()
+    elapsed = float(fields[0])
+    heavy = fields[1].split(',') if len(fields) == 2 else []
+    return (elapsed, heavy)
+
+def make_csv(row_count):
+    """
+    Returns the text of a CSV file like our logs: a mix of int,
+    float, and string columns.
+    """
+    lines = ['host,status,bytes,latency,path']
+    for i in xrange(row_count):
+        lines.append('host%d,%d,%d,%.3f,/page/%d' % (i % 17, 200 + i % 3, i * 7, i * 0.001, i % 101))
+    return '\n'.join(lines) + '\n'
+
+def measure_csv_rows_per_second(row_count=100000, column_names=None):
+    """
+    Reads a CSV file in memory with read_csv, and returns the number
+    of rows per second.
+    """
+    text = make_csv(row_count)
+    start = time.time()
+    read_csv(StringIO.StringIO(text), column_names)
+    elapsed = time.time() - start
+    return row_count / elapsed
+
+def main():
+    times = []
+    for i in range(5):
+        (elapsed, heavy) = measure_import_time()
+        times.append(elapsed)
+    print('import bstat: %.1f ms (best of 5)' % (min(times) * 1000.0))
+    if heavy:
+        print('    also imported: %s' % ', '.join(heavy))
+    for column_names in [None, ['status', 'latency']]:
+        rate = max(measure_csv_rows_per_second(column_names=column_names) for i in range(3))
+        print('read_csv %s: %.0f rows/sec (best of 3)' % (
+            'all columns' if column_names is None else ', '.join(column_names),
+            rate
+            ))
+
+class TestImportTime(unittest.TestCase):
+
+    def test_import_does_not_load_scipy(self):
+        (elapsed, heavy) = measure_import_time()
+        self.assertEqual([], heavy)
+
+    @timing_test
+    def test_import_time(self):
+        # With numpy and scipy, it takes about 200 ms.  Without them,
+        # it's about 20 ms.
+        best = min(measure_import_time()[0] for i in range(3))
+        self.assertTrue(best < 0.1, 'import bstat took %f seconds' % best)
+
+class TestReadCsv(unittest.TestCase):
+
+    @timing_test
+    def test_rows_per_second(self):
+        # It's about 300,000 rows/sec reading all five columns.
+        rate = max(measure_csv_rows_per_second(20000) for i in range(3))
+        self.assertTrue(50000 < rate, 'read_csv read %f rows/sec' % rate)
+
+if __name__ == '__main__':
+    main()
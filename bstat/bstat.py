@@ -6,38 +6,622 @@
 # 
 ######################################################################
 
+import bisect
+import collections
 import itertools
 import math
-import scipy.special
-import scipy.stats
+import multiprocessing
+import random
+import struct
+import time
 import unittest
 
-def percentile(v, p):
-    v = sorted(v)
-    position = (p / 100.0) * (len(v) - 1)
+from .lazy import numpy, scipy_special, scipy_stats
+
+# When asking for more than this many percentiles at once, it's
+# cheaper to sort the whole thing than to keep partitioning it.
+SELECTION_LIMIT = 8
+
+def _percentile_ranks(count, p):
+    """
+    Returns (index, next_index, position): the two ranks that straddle
+    the p-th percentile, and where it falls between them.
+    """
+    position = (p / 100.0) * (count - 1)
     index = int(position)
-    next_index = min(index + 1, len(v) - 1)
-    return v[index] * (next_index - position) + v[next_index] * (position - index)
+    next_index = min(index + 1, count - 1)
+    return (index, next_index, position)
+
+def _interpolate_percentile(value_at_rank, count, p):
+    """
+    Computes the p-th percentile, given a function that returns the
+    value at a given rank (the i-th smallest value).
+    """
+    (index, next_index, position) = _percentile_ranks(count, p)
+    if index == next_index:
+        return value_at_rank(index) * 1.0
+    return (
+        value_at_rank(index) * (next_index - position) +
+        value_at_rank(next_index) * (position - index)
+        )
+
+class PercentileSummary(object):
+
+    """
+    Base class for things that summarize a set of values well enough
+    to answer questions about percentiles.  Subclasses provide
+    percentile(p), get_count(), minimum(), and maximum().
+    """
+
+    def percentiles(self, ps):
+        return [self.percentile(p) for p in ps]
+
+    def median(self):
+        return self.percentile(50)
+
+    def trimean(self):
+        (q25, q50, q75) = self.percentiles([25, 50, 75])
+        return (q25 + 2 * q50 + q75) / 4.0
+
+    def interquartile_range(self):
+        (q25, q75) = self.percentiles([25, 75])
+        return q75 - q25
+
+class OrderStatistics(PercentileSummary):
+
+    """
+    Sorts a set of values once, and then answers any number of
+    questions about percentiles, quartiles, etc. without sorting
+    again.
+    """
+
+    def __init__(self, values):
+        self.sorted_values = sorted(values)
+        if len(self.sorted_values) == 0:
+            raise ValueError('no values')
+
+    def get_count(self):
+        return len(self.sorted_values)
+
+    def minimum(self):
+        return self.sorted_values[0]
+
+    def maximum(self):
+        return self.sorted_values[-1]
+
+    def percentile(self, p):
+        v = self.sorted_values
+        return _interpolate_percentile(v.__getitem__, len(v), p)
+
+class WeightedOrderStatistics(PercentileSummary):
+
+    """
+    Like OrderStatistics, but for data that has already been
+    summarized by counting the values, like this:
+
+        [(0, 1), (1, 2), (2, 5), (4, 1), (5, 1), (6,1)]
+
+    or as parallel lists of values and weights.  The answers are the
+    same as for OrderStatistics on the expanded list of values, but
+    the work depends only on the number of distinct values.
+    """
+
+    def __init__(self, values_and_counts=None, values=None, weights=None):
+        (values, weights) = _values_and_weights(values_and_counts, values, weights)
+        order = numpy.argsort(values, kind='mergesort')
+        self.sorted_values = values[order]
+        self.cumulative_weights = numpy.cumsum(weights[order])
+        if len(values) == 0 or self.cumulative_weights[-1] <= 0:
+            raise ValueError('no values')
+        # Values with no weight can't be the minimum or maximum.
+        self.present = numpy.flatnonzero(weights[order] > 0)
+
+    def get_count(self):
+        return float(self.cumulative_weights[-1])
+
+    def minimum(self):
+        return float(self.sorted_values[self.present[0]])
+
+    def maximum(self):
+        return float(self.sorted_values[self.present[-1]])
+
+    def _value_at_rank(self, i):
+        index = numpy.searchsorted(self.cumulative_weights, i, side='right')
+        return self.sorted_values[min(index, len(self.sorted_values) - 1)]
+
+    def percentile(self, p):
+        count = int(math.ceil(self.get_count()))
+        return float(_interpolate_percentile(self._value_at_rank, count, p))
+
+class QuantileSketch(PercentileSummary):
+
+    """
+    Summarizes an unbounded stream of values in a bounded amount of
+    memory, well enough to answer approximate percentile questions.
+
+    This is a KLL sketch, from "Optimal Quantile Approximation in
+    Streams" by Karnin, Lang, and Liberty (2016).  Values go into a
+    stack of compactors.  When a compactor fills up, it is sorted and
+    every other value is promoted to the next compactor up, where it
+    counts double.
+
+    Error bound: the answer for the p-th percentile is the true value
+    at some percentile between p - e and p + e, where e is about
+    330 / k percentile points, with 99% confidence.  With the default
+    k of 200, that's within 1.65 percentile points.  Memory use is
+    about 3 * k values no matter how many values have been added.
+
+    The minimum and maximum are always exact, and the answers are
+    exact until the sketch fills up for the first time.
+
+    Sketches built on different workers can be merged, and can be
+    serialized with to_bytes() and from_bytes().
+    """
+
+    MAGIC = 'BQS1'
+    HEADER = struct.Struct('<4sIQdd')
+
+    # add_many() hands values to the sketch in batches of this many,
+    # which are sorted and compacted with numpy.
+    BATCH_SIZE = 10000
+
+    def __init__(self, values=None, k=200, seed=None):
+        self.k = k
+        self.count = 0
+        self.min_value = None
+        self.max_value = None
+        self.compactors = [[]]
+        self.random = random.Random(seed)
+        self.sorted_items = None
+        self._recount()
+        if values is not None:
+            self.add_many(values)
+
+    def _recount(self):
+        """
+        Updates the number of values held, and the capacity of each
+        level, which depends on how many levels there are.  These are
+        kept as counters so that adding a value doesn't have to add
+        up the levels.
+        """
+        self.size = sum(len(c) for c in self.compactors)
+        level_count = len(self.compactors)
+        self.capacities = [
+            int(math.ceil(self.k * ((2.0 / 3.0) ** (level_count - h - 1)))) + 1
+            for h in xrange(level_count)
+            ]
+        self.max_size = sum(self.capacities)
+
+    def _compact(self, h):
+        """
+        Sorts level h, and promotes every other value to the next
+        level up, where it counts double.
+        """
+        if h + 1 == len(self.compactors):
+            self.compactors.append([])
+            self._recount()
+        items = self.compactors[h]
+        if self.BATCH_SIZE <= len(items):
+            items = numpy.sort(numpy.asarray(items)).tolist()
+        else:
+            items.sort()
+        leftover = [items.pop()] if len(items) % 2 == 1 else []
+        promoted = items[self.random.randint(0, 1)::2]
+        self.compactors[h] = leftover
+        self.compactors[h + 1].extend(promoted)
+        self.size -= len(items) - len(promoted)
+
+    def _compress(self):
+        """
+        Compacts levels, starting at the bottom, until the sketch is
+        back under its size limit.
+        """
+        while self.max_size <= self.size:
+            for h in xrange(len(self.compactors)):
+                if self.capacities[h] <= len(self.compactors[h]):
+                    self._compact(h)
+                    break
+
+    def _note_range(self, low, high):
+        if self.min_value is None or low < self.min_value:
+            self.min_value = low
+        if self.max_value is None or self.max_value < high:
+            self.max_value = high
+
+    def add(self, value):
+        self._note_range(value, value)
+        self.compactors[0].append(value)
+        self.count += 1
+        self.size += 1
+        self.sorted_items = None
+        if self.max_size <= self.size:
+            self._compress()
+
+    def add_many(self, values):
+        """
+        Adds values from any iterable.  They're read BATCH_SIZE at a
+        time, so an unbounded stream takes a bounded amount of memory.
+        Each batch goes into the bottom level all at once, and is
+        compacted there with one sort.
+        """
+        values = iter(values)
+        while True:
+            chunk = list(itertools.islice(values, self.BATCH_SIZE))
+            if len(chunk) == 0:
+                return
+            self._note_range(min(chunk), max(chunk))
+            self.count += len(chunk)
+            self.size += len(chunk)
+            self.sorted_items = None
+            self.compactors[0].extend(chunk)
+            self._compress()
+
+    def merge(self, other):
+        """
+        Folds another sketch into this one.
+        """
+        if other.count == 0:
+            return self
+        self._note_range(other.min_value, other.max_value)
+        self.count += other.count
+        self.sorted_items = None
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for (mine, theirs) in zip(self.compactors, other.compactors):
+            mine.extend(theirs)
+        self._recount()
+        self._compress()
+        return self
+
+    def get_count(self):
+        return self.count
+
+    def minimum(self):
+        return self.min_value
+
+    def maximum(self):
+        return self.max_value
+
+    def _get_sorted_items(self):
+        """
+        Returns (values, cumulative_weights), with the values from all
+        of the compactors in sorted order.  A value at level h stands
+        for 2**h of the original values.
+        """
+        if self.sorted_items is None:
+            weighted = sorted(
+                (v, 1 << h)
+                for (h, compactor) in enumerate(self.compactors)
+                for v in compactor
+                )
+            values = []
+            cumulative_weights = []
+            total = 0
+            for (v, w) in weighted:
+                total += w
+                values.append(v)
+                cumulative_weights.append(total)
+            self.sorted_items = (values, cumulative_weights)
+        return self.sorted_items
+
+    def percentile(self, p):
+        if self.count == 0:
+            raise ValueError('no values')
+        (values, cumulative_weights) = self._get_sorted_items()
+        def value_at_rank(i):
+            return values[bisect.bisect_right(cumulative_weights, i)]
+        return _interpolate_percentile(value_at_rank, self.count, p)
+
+    def to_bytes(self):
+        """
+        Returns a compact binary form of the sketch: a header, the
+        size of each compactor, and then all of the values as
+        doubles.
+        """
+        sizes = [len(c) for c in self.compactors]
+        values = [v for c in self.compactors for v in c]
+        return ''.join([
+            self.HEADER.pack(
+                self.MAGIC, self.k, self.count,
+                self.min_value if self.count else 0.0,
+                self.max_value if self.count else 0.0
+                ),
+            struct.pack('<I', len(sizes)),
+            struct.pack('<%dI' % len(sizes), *sizes),
+            struct.pack('<%dd' % len(values), *values)
+            ])
+
+    @classmethod
+    def from_bytes(cls, data, seed=None):
+        (magic, k, count, min_value, max_value) = cls.HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC:
+            raise ValueError('not a serialized QuantileSketch')
+        offset = cls.HEADER.size
+        (level_count,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        sizes = struct.unpack_from('<%dI' % level_count, data, offset)
+        offset += 4 * level_count
+        values = struct.unpack_from('<%dd' % sum(sizes), data, offset)
+        result = cls(k=k, seed=seed)
+        result.count = count
+        if count != 0:
+            result.min_value = min_value
+            result.max_value = max_value
+        result.compactors = []
+        start = 0
+        for size in sizes:
+            result.compactors.append(list(values[start:start + size]))
+            start += size
+        result._recount()
+        return result
+
+def percentiles(v, ps):
+    """
+    Returns a list holding the p-th percentile of v for each p in ps.
+
+    v can be a sequence of numbers, or a PercentileSummary (like an
+    OrderStatistics or a QuantileSketch) that already summarizes
+    them.  When only a few percentiles are needed, the values are
+    partitioned around just the ranks needed, which is O(n) rather
+    than O(n log n).
+    """
+    if isinstance(v, PercentileSummary):
+        return v.percentiles(ps)
+    a = numpy.array(v if hasattr(v, '__len__') else list(v), dtype=float)
+    count = len(a)
+    if count == 0:
+        raise ValueError('no values')
+    ranks = set()
+    for p in ps:
+        (index, next_index, position) = _percentile_ranks(count, p)
+        ranks.add(index)
+        ranks.add(next_index)
+    if len(ranks) <= SELECTION_LIMIT:
+        a.partition(sorted(ranks))
+    else:
+        a.sort()
+    return [float(_interpolate_percentile(a.__getitem__, count, p)) for p in ps]
+
+def percentile(v, p):
+    return percentiles(v, [p])[0]
 
 def trimean(v):
-    return (percentile(v, 25) + 2 * percentile(v, 50) + percentile(v, 75)) / 4.0
+    (q25, q50, q75) = percentiles(v, [25, 50, 75])
+    return (q25 + 2 * q50 + q75) / 4.0
+
+class Moments(object):
+
+    """
+    Accumulates the count, mean, and variance of a set of values in
+    one pass, using Welford's method so that precision isn't lost
+    subtracting two big sums of squares.
+
+    Values can be added one at a time with add(), or in batches with
+    add_many().  Accumulators that saw different parts of the data
+    can be combined with merge(), and the result is the same as if
+    one accumulator had seen all of the data.
+    """
+
+    def __init__(self, values=None):
+        self.count = 0
+        self.mean_value = 0.0
+        self.sum_of_squared_deviations = 0.0
+        if values is not None:
+            self.add_many(values)
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean_value
+        self.mean_value += delta / float(self.count)
+        self.sum_of_squared_deviations += delta * (x - self.mean_value)
+
+    def remove(self, x):
+        """
+        Takes back a value that was added earlier.  This is the
+        inverse of add(), and is what makes rolling windows cheap.
+        """
+        if self.count <= 1:
+            self.__init__()
+            return
+        self.count -= 1
+        delta = x - self.mean_value
+        self.mean_value -= delta / float(self.count)
+        self.sum_of_squared_deviations -= delta * (x - self.mean_value)
+        # Rounding can take it a hair below zero when the values left
+        # are all (nearly) the same.
+        if self.sum_of_squared_deviations < 0.0:
+            self.sum_of_squared_deviations = 0.0
+
+    def add_many(self, values, weights=None):
+        """
+        Adds a batch of values.  The batch is summarized with numpy,
+        and then merged in.
+
+        If weights are given, each value counts as if it had been
+        added that many times.
+        """
+        a = numpy.asarray(values if hasattr(values, '__len__') else list(values), dtype=float)
+        if len(a) == 0:
+            return
+        batch = Moments()
+        if weights is None:
+            batch.count = len(a)
+            batch.mean_value = float(a.mean())
+            batch.sum_of_squared_deviations = float(numpy.square(a - batch.mean_value).sum())
+        else:
+            w = numpy.asarray(weights, dtype=float)
+            batch.count = float(w.sum())
+            if batch.count == 0:
+                return
+            batch.mean_value = float(numpy.dot(w, a) / batch.count)
+            batch.sum_of_squared_deviations = float(numpy.dot(w, numpy.square(a - batch.mean_value)))
+        self.merge(batch)
+
+    def merge(self, other):
+        """
+        Folds the values seen by another Moments into this one.
+        """
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean_value - self.mean_value
+        self.mean_value += delta * other.count / float(count)
+        self.sum_of_squared_deviations += (
+            other.sum_of_squared_deviations +
+            delta * delta * self.count * other.count / float(count)
+            )
+        self.count = count
+        return self
+
+    def get_count(self):
+        return self.count
+
+    def mean(self):
+        if self.count == 0:
+            raise ValueError('no values')
+        return self.mean_value
+
+    def variance(self):
+        """
+        The sample variance, which divides by n - 1.
+        """
+        if self.count < 2:
+            raise ValueError('need at least two values')
+        return self.sum_of_squared_deviations / (self.count - 1.0)
+
+    def standard_deviation(self):
+        return math.sqrt(self.variance())
+
+class CoMoments(object):
+
+    """
+    Like Moments, but for pairs of values (x, y).  In addition to the
+    mean and variance of both x and y, this keeps track of their
+    covariance, which is what you need for the correlation
+    coefficient.
+    """
+
+    def __init__(self, xs=None, ys=None):
+        self.x = Moments()
+        self.y = Moments()
+        self.sum_of_products = 0.0
+        if xs is not None:
+            self.add_many(xs, ys)
+
+    def add(self, x, y):
+        dx = x - self.x.mean_value
+        self.x.add(x)
+        self.y.add(y)
+        self.sum_of_products += dx * (y - self.y.mean_value)
+
+    def add_many(self, xs, ys):
+        a = numpy.asarray(xs if hasattr(xs, '__len__') else list(xs), dtype=float)
+        b = numpy.asarray(ys if hasattr(ys, '__len__') else list(ys), dtype=float)
+        if len(a) != len(b):
+            raise ValueError('x and y have different lengths')
+        if len(a) == 0:
+            return
+        batch = CoMoments()
+        batch.x.add_many(a)
+        batch.y.add_many(b)
+        batch.sum_of_products = float(
+            numpy.dot(a - batch.x.mean_value, b - batch.y.mean_value)
+            )
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.x.count == 0:
+            return self
+        count = self.x.count + other.x.count
+        dx = other.x.mean_value - self.x.mean_value
+        dy = other.y.mean_value - self.y.mean_value
+        self.sum_of_products += (
+            other.sum_of_products +
+            dx * dy * self.x.count * other.x.count / float(count)
+            )
+        self.x.merge(other.x)
+        self.y.merge(other.y)
+        return self
+
+    def get_count(self):
+        return self.x.count
+
+    def covariance(self):
+        """
+        The sample covariance, which divides by n - 1.
+        """
+        if self.x.count < 2:
+            raise ValueError('need at least two values')
+        return self.sum_of_products / (self.x.count - 1.0)
+
+    def correlation(self):
+        return self.sum_of_products / math.sqrt(
+            self.x.sum_of_squared_deviations * self.y.sum_of_squared_deviations
+            )
+
+def _values_and_weights(values_and_counts=None, values=None, weights=None):
+    """
+    Takes either a list of (value, count) pairs, or parallel lists of
+    values and weights, and returns (values, weights) as numpy arrays.
+    """
+    if values_and_counts is not None:
+        if values is not None or weights is not None:
+            raise ValueError('Only one of values_and_counts or values and weights should be set')
+        pairs = numpy.asarray(list(values_and_counts), dtype=float).reshape(-1, 2)
+        return (pairs[:, 0], pairs[:, 1])
+    if values is None or weights is None:
+        raise ValueError('Either values_and_counts or values and weights should be set')
+    values = numpy.asarray(values, dtype=float)
+    weights = numpy.asarray(weights, dtype=float)
+    if values.shape != weights.shape:
+        raise ValueError('values and weights have different lengths')
+    return (values, weights)
 
 def mean(v):
-    return float(sum(v)) / float(len(v))
+    return Moments(v).mean()
 
 def sum_of_squares(v):
     return sum(x * x for x in v)
 
 def standard_deviation(v):
-    m = mean(v)
-    variance = sum_of_squares(x - m for x in v) / (len(v) - 1.0)
-    return math.sqrt(variance)
+    return Moments(v).standard_deviation()
 
 def interquartile_range(v):
-    q25 = percentile(v, 25)
-    q75 = percentile(v, 75)
+    (q25, q75) = percentiles(v, [25, 75])
     return q75 - q25
 
+# Weighted versions of the above, for data that has been summarized
+# as (value, count) pairs.  For example, weighted_mean([(1, 2), (4, 1)])
+# is 2.  To pass parallel lists instead, use weights:
+# weighted_mean([1, 4], weights=[2, 1]).
+
+def _weighted_order_statistics(v, weights):
+    if weights is None:
+        return WeightedOrderStatistics(values_and_counts=v)
+    return WeightedOrderStatistics(values=v, weights=weights)
+
+def _weighted_moments(v, weights):
+    if weights is None:
+        (v, weights) = _values_and_weights(values_and_counts=v)
+    moments = Moments()
+    moments.add_many(v, weights)
+    return moments
+
+def weighted_mean(v, weights=None):
+    return _weighted_moments(v, weights).mean()
+
+def weighted_standard_deviation(v, weights=None):
+    return _weighted_moments(v, weights).standard_deviation()
+
+def weighted_percentile(v, p, weights=None):
+    return _weighted_order_statistics(v, weights).percentile(p)
+
+def weighted_trimean(v, weights=None):
+    return _weighted_order_statistics(v, weights).trimean()
+
+def weighted_interquartile_range(v, weights=None):
+    return _weighted_order_statistics(v, weights).interquartile_range()
+
 def group_pairs(seq):
     for (i, x) in enumerate(seq):
         if i % 2 == 0:
@@ -57,11 +641,264 @@ def dot_product(x, y):
     return sum(a * b for (a, b) in zip(x, y))
 
 def correlation_coefficient(X, Y):
-    x = deviations(X)
-    y = deviations(Y)
-    x_squares = sum_of_squares(x)
-    y_squares = sum_of_squares(y)
-    return dot_product(x, y) / math.sqrt(x_squares * y_squares)
+    return CoMoments(X, Y).correlation()
+
+class _End(object):
+
+    """
+    Compares greater than everything.  Marks the end of the lists in
+    an IndexableSkiplist.
+    """
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return self is other
+
+    def __gt__(self, other):
+        return self is not other
+
+    def __ge__(self, other):
+        return True
+
+class _SkiplistNode(object):
+
+    __slots__ = ('value', 'next', 'width')
+
+    def __init__(self, value, next, width):
+        self.value = value
+        self.next = next
+        self.width = width
+
+_SKIPLIST_END = _SkiplistNode(_End(), [], [])
+
+class IndexableSkiplist(object):
+
+    """
+    A sorted collection that supports inserting, removing, and looking
+    up a value by its rank, all in O(log n).
+
+    This is Raymond Hettinger's recipe: each link in the skiplist
+    knows how many values it skips over, so finding the i-th value is
+    just a matter of adding up widths on the way down.
+
+    The number of levels is picked from expected_size, and more are
+    added if the list grows beyond it.
+    """
+
+    def __init__(self, expected_size=100):
+        self.size = 0
+        self.max_levels = int(1 + math.log(max(2, expected_size), 2))
+        self.head = _SkiplistNode(
+            'HEAD',
+            [_SKIPLIST_END] * self.max_levels,
+            [1] * self.max_levels
+            )
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not (0 <= i < self.size):
+            raise IndexError('skiplist index out of range')
+        node = self.head
+        i += 1
+        for level in reversed(xrange(self.max_levels)):
+            while node.width[level] <= i:
+                i -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not _SKIPLIST_END:
+            yield node.value
+            node = node.next[0]
+
+    def _grow(self):
+        """
+        Adds a level on top, so that lookups stay O(log n) when more
+        values go in than expected_size said.  The new level starts
+        out with just the head, which skips over everything.
+        """
+        self.head.next.append(_SKIPLIST_END)
+        self.head.width.append(self.size + 1)
+        self.max_levels += 1
+
+    def insert(self, value):
+        while (1 << self.max_levels) <= self.size:
+            self._grow()
+
+        # Find the last node on each level that comes before value.
+        chain = [None] * self.max_levels
+        steps_at_level = [0] * self.max_levels
+        node = self.head
+        for level in reversed(xrange(self.max_levels)):
+            while node.next[level].value <= value:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        # Link in the new node on a random number of levels.
+        d = min(self.max_levels, 1 - int(math.log(1.0 - random.random(), 2.0)))
+        new_node = _SkiplistNode(value, [None] * d, [None] * d)
+        steps = 0
+        for level in xrange(d):
+            prev_node = chain[level]
+            new_node.next[level] = prev_node.next[level]
+            prev_node.next[level] = new_node
+            new_node.width[level] = prev_node.width[level] - steps
+            prev_node.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in xrange(d, self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        # Find the last node on each level that comes before value.
+        chain = [None] * self.max_levels
+        node = self.head
+        for level in reversed(xrange(self.max_levels)):
+            while node.next[level].value < value:
+                node = node.next[level]
+            chain[level] = node
+        if chain[0].next[0] is _SKIPLIST_END or value != chain[0].next[0].value:
+            raise KeyError('not found: %r' % (value,))
+
+        # Unlink it from every level it's on.
+        d = len(chain[0].next[0].next)
+        for level in xrange(d):
+            prev_node = chain[level]
+            prev_node.width[level] += prev_node.next[level].width[level] - 1
+            prev_node.next[level] = prev_node.next[level].next[level]
+        for level in xrange(d, self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+# When removing one value from a RollingWindow takes away more than
+# this many times the sum of squared deviations that's left, the
+# window's Moments are recomputed from scratch.
+RESYNC_RATIO = 1000.0
+
+class RollingWindow(PercentileSummary):
+
+    """
+    Statistics over the most recent values in a stream: the last size
+    values, or the values from the last duration seconds, or both.
+    Pushing a new value evicts the ones that have fallen out of the
+    window.
+
+    The mean and standard deviation are updated in O(1) per value,
+    and percentiles in O(log n), using an IndexableSkiplist.  If you
+    don't need percentiles, pass order_statistics=False to skip
+    keeping the values sorted.
+    """
+
+    def __init__(self, size=None, duration=None, order_statistics=True):
+        if size is None and duration is None:
+            raise ValueError('either size or duration should be set')
+        self.size = size
+        self.duration = duration
+        self.entries = collections.deque()
+        self.moments = Moments()
+        self.removed_since_resync = 0
+        if order_statistics:
+            # For duration windows, the skiplist grows levels as needed.
+            self.sorted_values = IndexableSkiplist(size or 1000)
+        else:
+            self.sorted_values = None
+
+    def push(self, value, timestamp=None):
+        """
+        Adds a value to the window.  When the window has a duration,
+        the timestamp (in seconds) defaults to now.
+        """
+        if timestamp is None and self.duration is not None:
+            timestamp = time.time()
+        self.entries.append((timestamp, value))
+        self.moments.add(value)
+        if self.sorted_values is not None:
+            self.sorted_values.insert(value)
+        if self.size is not None and self.size < len(self.entries):
+            self._evict_oldest()
+        if self.duration is not None:
+            self.advance(timestamp)
+
+    def advance(self, timestamp):
+        """
+        Evicts values that are older than duration seconds before
+        timestamp.  Windows with just a size have nothing to evict.
+        """
+        if self.duration is None:
+            return
+        cutoff = timestamp - self.duration
+        while self.entries and self.entries[0][0] <= cutoff:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        (timestamp, value) = self.entries.popleft()
+        before = self.moments.sum_of_squared_deviations
+        self.moments.remove(value)
+        after = self.moments.sum_of_squared_deviations
+        if self.sorted_values is not None:
+            self.sorted_values.remove(value)
+
+        # Each remove() adds a little rounding error, which matters a
+        # lot when the values left are nearly the same.  Recomputing
+        # from scratch once per window's worth of removals keeps the
+        # error from building up, and costs O(1) per value amortized.
+        # Removing an outlier that held most of the variance loses
+        # too much precision to wait for that, so it's done right
+        # away.
+        self.removed_since_resync += 1
+        if (len(self.entries) <= 2 or
+            len(self.entries) <= self.removed_since_resync or
+            RESYNC_RATIO * after < before - after):
+            self._resync_moments()
+
+    def _resync_moments(self):
+        self.moments = Moments()
+        for (timestamp, value) in self.entries:
+            self.moments.add(value)
+        self.removed_since_resync = 0
+
+    def get_count(self):
+        return len(self.entries)
+
+    def get_values(self):
+        """
+        Returns the values in the window, oldest first.
+        """
+        return [value for (timestamp, value) in self.entries]
+
+    def mean(self):
+        return self.moments.mean()
+
+    def variance(self):
+        return self.moments.variance()
+
+    def standard_deviation(self):
+        return self.moments.standard_deviation()
+
+    def _get_sorted_values(self):
+        if self.sorted_values is None:
+            raise ValueError('this window does not keep order statistics')
+        if len(self.sorted_values) == 0:
+            raise ValueError('no values')
+        return self.sorted_values
+
+    def minimum(self):
+        return self._get_sorted_values()[0]
+
+    def maximum(self):
+        return self._get_sorted_values()[-1]
+
+    def percentile(self, p):
+        v = self._get_sorted_values()
+        return _interpolate_percentile(v.__getitem__, len(v), p)
 
 def product(seq):
     result = 1
@@ -72,34 +909,84 @@ def product(seq):
 def factorial(n):
     return product(xrange(1, n + 1))
 
+def log_factorial(n):
+    """
+    The natural log of n!, computed with lgamma so that it works for
+    big n.  n can be a number or an array.
+    """
+    return scipy_special.gammaln(numpy.asarray(n, dtype=float) + 1.0)
+
+def _scalar_or_array(a):
+    """
+    Results computed on arrays come back as arrays, but results
+    computed on plain numbers should come back as plain numbers.
+    """
+    if numpy.ndim(a) == 0:
+        return float(a)
+    return a
+
 def binomial_probability(N, x, pi):
-    return (
-        (factorial(N) / float(factorial(x) * factorial(N - x))) *
-        pow(pi, x) *
-        pow(1.0 - pi, N - x)
+    """
+    Given N trials, each of which succeeds with probability pi, what
+    is the probability of exactly x successes?
+
+    The arguments can be arrays (they are broadcast against each
+    other), in which case the result is an array.  The work is done
+    in log space, so N can be in the millions without overflowing.
+    """
+    N = numpy.asarray(N, dtype=float)
+    x = numpy.asarray(x, dtype=float)
+    pi = numpy.asarray(pi, dtype=float)
+    in_range = (0 <= x) & (x <= N)
+    x_ok = numpy.where(in_range, x, 0.0)
+    log_p = (
+        log_factorial(N) - log_factorial(x_ok) - log_factorial(N - x_ok) +
+        scipy_special.xlogy(x_ok, pi) +
+        scipy_special.xlog1py(N - x_ok, -pi)
         )
+    return _scalar_or_array(numpy.where(in_range, numpy.exp(log_p), 0.0))
 
 def binomial_probabilities(N, vx, pi):
-    return sum(binomial_probability(N, x, pi) for x in vx)
+    """
+    The probability that the number of successes is one of the
+    values in vx.
+    """
+    vx = numpy.asarray(vx if hasattr(vx, '__len__') else list(vx), dtype=float)
+    return float(numpy.sum(binomial_probability(N, vx, pi)))
 
 def poisson_probability(mu, x):
     """
     Given a mean number of successes, mu, what is the probability of x
     successes?
+
+    Like binomial_probability, mu and x can be arrays.
     """
-    return math.exp(-mu) * pow(mu, x) / factorial(x)
+    mu = numpy.asarray(mu, dtype=float)
+    x = numpy.asarray(x, dtype=float)
+    in_range = (0 <= x)
+    x_ok = numpy.where(in_range, x, 0.0)
+    log_p = scipy_special.xlogy(x_ok, mu) - mu - log_factorial(x_ok)
+    return _scalar_or_array(numpy.where(in_range, numpy.exp(log_p), 0.0))
 
 def multinomial_probability(v_prob, v_count):
     """
     Given a number of possible outcomes, where the probability of each
     is v_prob[i], what is the probability outcome i will happen
     v_count[i] times, for all i.
+
+    v_count can also be a 2-D array, with one set of counts in each
+    row, in which case the result is an array with one probability
+    per row.
     """
-    assert len(v_prob) == len(v_count)
-    return (
-        (float(factorial(sum(v_count))) / product(factorial(ni) for ni in v_count)) *
-        product(pow(pi, ni) for (pi, ni) in zip(v_prob, v_count))
+    v_prob = numpy.asarray(v_prob, dtype=float)
+    v_count = numpy.asarray(v_count, dtype=float)
+    assert v_prob.shape[-1] == v_count.shape[-1]
+    log_p = (
+        log_factorial(v_count.sum(axis=-1)) -
+        log_factorial(v_count).sum(axis=-1) +
+        scipy_special.xlogy(v_count, v_prob).sum(axis=-1)
         )
+    return _scalar_or_array(numpy.exp(log_p))
 
 def bayes(p_B_A, p_B_notA, p_A):
     """
@@ -120,10 +1007,76 @@ def percent_in_range_normal(mean, sd, low, high):
     """
     low_sigma = float(low - mean) / sd
     high_sigma = float(high - mean) / sd
-    low_percentile = scipy.stats.norm.cdf(low_sigma)
-    high_percentile = scipy.stats.norm.cdf(high_sigma)
+    low_percentile = scipy_stats.norm.cdf(low_sigma)
+    high_percentile = scipy_stats.norm.cdf(high_sigma)
     return high_percentile - low_percentile
 
+class BoundedCache(object):
+
+    """
+    A dict-like cache that holds at most max_size entries, throwing
+    out the least recently used entry when it gets full.  It counts
+    hits and misses, so you can tell whether it's big enough.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """
+        Returns the cached value for key, calling compute() to make it
+        if it's not there yet.
+        """
+        if key in self.entries:
+            self.hits += 1
+            value = self.entries.pop(key)
+        else:
+            self.misses += 1
+            value = compute()
+            if self.max_size <= len(self.entries):
+                self.entries.popitem(last=False)
+        self.entries[key] = value
+        return value
+
+    def get_info(self):
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'size' : len(self.entries),
+            'max_size' : self.max_size
+            }
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+# Counts up to this are small enough to be worth caching.
+POISSON_CACHE_MAX_COUNT = 10000
+
+# Caches the gamma quantiles (in occurrences, not rates) used by
+# poisson_confidence_interval, keyed by (count, confidence).
+poisson_quantile_cache = BoundedCache(20000)
+
+def _poisson_quantiles(number_of_occurrences, confidence):
+    """
+    Returns the (low, high) number of occurrences at the ends of the
+    confidence range.
+    """
+    a = 1.0 - confidence
+    if number_of_occurrences != 0:
+        low_occurrences = scipy_special.gammaincinv(number_of_occurrences, a / 2.0)
+    else:
+        low_occurrences = 0.0
+    high_occurrences = scipy_special.gammaincinv(number_of_occurrences + 1, 1.0 - a / 2.0)
+    return (low_occurrences, high_occurrences)
+
 def poisson_confidence_interval(number_of_occurrences, sample_size, confidence=0.95):
     """
     Returns a triple (low, rate, high):
@@ -132,22 +1085,166 @@ def poisson_confidence_interval(number_of_occurrences, sample_size, confidence=0
         expected - the best guess at the rate
         high - the rate that is the upper bound of the confidence range
 
+    The quantiles for small whole-number counts are remembered in
+    poisson_quantile_cache, so repeated calls are just a lookup.
+
     https://en.wikipedia.org/wiki/Poisson_distribution (see CDF)
     http://newton.cx/~peter/2012/06/poisson-distribution-confidence-intervals/
     """
     if sample_size == 0:
         raise Exception("sample_size cannot be 0")
     rate = float(number_of_occurrences) / float(sample_size)
-    a = 1.0 - confidence
-    if number_of_occurrences != 0:
-        low_occurrences = scipy.special.gammaincinv(number_of_occurrences, a / 2.0)
-        low_rate = low_occurrences / sample_size
+    # NaN and infinity fail the range check, before int() can choke
+    # on them, and take the uncached path.
+    if (0 <= number_of_occurrences <= POISSON_CACHE_MAX_COUNT and
+        number_of_occurrences == int(number_of_occurrences)):
+        (low_occurrences, high_occurrences) = poisson_quantile_cache.get(
+            (int(number_of_occurrences), confidence),
+            lambda: _poisson_quantiles(number_of_occurrences, confidence)
+            )
     else:
-        low_rate = 0.0
-    high_occurrences = scipy.special.gammaincinv(number_of_occurrences + 1, 1.0 - a / 2.0)
+        (low_occurrences, high_occurrences) = _poisson_quantiles(number_of_occurrences, confidence)
+    low_rate = low_occurrences / sample_size
     high_rate = high_occurrences / sample_size
     return (low_rate, rate, high_rate)
 
+def poisson_confidence_intervals(numbers_of_occurrences, sample_sizes, confidence=0.95):
+    """
+    The same as poisson_confidence_interval, but for arrays of counts
+    and sample sizes (and, optionally, confidences), all of which are
+    broadcast against each other.  Returns a triple of arrays (low,
+    rate, high).
+    """
+    occurrences = numpy.asarray(numbers_of_occurrences, dtype=float)
+    sample_sizes = numpy.asarray(sample_sizes, dtype=float)
+    a = 1.0 - numpy.asarray(confidence, dtype=float)
+    if numpy.any(sample_sizes == 0):
+        raise Exception("sample_size cannot be 0")
+    rate = occurrences / sample_sizes
+    # gammaincinv(0, ...) is undefined, so zero counts are computed
+    # with a dummy count of 1 and then masked to a low rate of 0.
+    nonzero = (occurrences != 0)
+    low_occurrences = scipy_special.gammaincinv(numpy.where(nonzero, occurrences, 1.0), a / 2.0)
+    low_rate = numpy.where(nonzero, low_occurrences / sample_sizes, 0.0)
+    high_occurrences = scipy_special.gammaincinv(occurrences + 1, 1.0 - a / 2.0)
+    high_rate = high_occurrences / sample_sizes
+    return (low_rate, rate, high_rate)
+
+# Bootstrap resamples are generated this many values at a time, which
+# bounds the memory used to a few hundred MB.
+BOOTSTRAP_BATCH_VALUES = 4000000
+
+def _rowwise_correlation(x, y):
+    dx = x - x.mean(axis=1)[:, numpy.newaxis]
+    dy = y - y.mean(axis=1)[:, numpy.newaxis]
+    return (dx * dy).sum(axis=1) / numpy.sqrt((dx * dx).sum(axis=1) * (dy * dy).sum(axis=1))
+
+def _rowwise_trimean(a):
+    (q25, q50, q75) = numpy.percentile(a, [25, 50, 75], axis=1)
+    return (q25 + 2 * q50 + q75) / 4.0
+
+def _rowwise_interquartile_range(a):
+    (q25, q75) = numpy.percentile(a, [25, 75], axis=1)
+    return q75 - q25
+
+# Versions of the statistics in this module that take a 2-D array,
+# with one resample in each row, and compute all of the rows at once.
+# (numpy's default percentile interpolation matches percentile().)
+ROWWISE_STATISTICS = {
+    mean : lambda a: a.mean(axis=1),
+    standard_deviation : lambda a: a.std(axis=1, ddof=1),
+    percentile : lambda a, p: numpy.percentile(a, p, axis=1),
+    trimean : _rowwise_trimean,
+    interquartile_range : _rowwise_interquartile_range,
+    correlation_coefficient : _rowwise_correlation
+    }
+
+# State for bootstrap worker processes, set once per process so that
+# the data isn't shipped with every chunk.
+_bootstrap_state = None
+
+def _set_bootstrap_state(statistic, arrays, args):
+    global _bootstrap_state
+    _bootstrap_state = (statistic, arrays, args)
+
+def _bootstrap_chunk(chunk):
+    """
+    Computes the statistic on a chunk of resamples.  Each chunk has
+    its own random seed, derived from the overall seed and the chunk
+    number, so the results don't depend on how many processes are
+    used.
+    """
+    (seed, chunk_index, replicate_count) = chunk
+    (statistic, arrays, args) = _bootstrap_state
+    n = len(arrays[0])
+    rng = numpy.random.RandomState([seed, chunk_index])
+    indices = rng.randint(0, n, size=(replicate_count, n))
+    samples = [a[indices] for a in arrays]
+    if statistic in ROWWISE_STATISTICS:
+        return ROWWISE_STATISTICS[statistic](*(samples + list(args)))
+    return numpy.array([
+        statistic(*([s[i] for s in samples] + list(args)))
+        for i in xrange(replicate_count)
+        ], dtype=float)
+
+def bootstrap(statistic, data, replicates=1000, confidence=0.95, args=(),
+              seed=None, processes=None):
+    """
+    Returns a triple (low, estimate, high), where estimate is
+    statistic(data, *args), and low and high are the ends of a
+    bootstrap confidence interval for it.
+
+    data is a sequence of values.  For statistics that take more than
+    one sequence, like correlation_coefficient, pass a tuple of
+    sequences; each resample picks the same positions from all of
+    them.
+
+    The statistics in this module are computed on a whole batch of
+    resamples at once with numpy.  Any other statistic is called once
+    per resample.
+
+    If processes is given, the resamples are spread over a pool of
+    that many processes.  The answer for a given seed is the same no
+    matter how many processes are used.
+    """
+    if not isinstance(data, tuple):
+        data = (data,)
+    arrays = [numpy.asarray(d, dtype=float) for d in data]
+    n = len(arrays[0])
+    if n == 0:
+        raise ValueError('no values')
+    if any(len(a) != n for a in arrays):
+        raise ValueError('data sequences have different lengths')
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2 ** 32 - 1)
+
+    # Split the work into chunks small enough to fit in memory.
+    chunk_size = max(1, BOOTSTRAP_BATCH_VALUES // n)
+    chunks = [
+        (seed, i, min(chunk_size, replicates - start))
+        for (i, start) in enumerate(xrange(0, replicates, chunk_size))
+        ]
+    if processes is None:
+        _set_bootstrap_state(statistic, arrays, args)
+        results = [_bootstrap_chunk(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(
+            processes,
+            initializer=_set_bootstrap_state,
+            initargs=(statistic, arrays, args)
+            )
+        try:
+            results = pool.map(_bootstrap_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    estimates = numpy.concatenate(results)
+
+    a = 1.0 - confidence
+    (low, high) = percentiles(estimates, [100.0 * a / 2.0, 100.0 * (1.0 - a / 2.0)])
+    estimate = statistic(*(list(data) + list(args)))
+    return (low, estimate, high)
+
 class TestStats(unittest.TestCase):
 
     def test_standard_deviation(self):
@@ -159,6 +1256,32 @@ class TestStats(unittest.TestCase):
                                  8, 10, 11, 12, 13, 22, 23, 24, 25])
         self.assertAlmostEqual(6, r)
 
+    def test_percentile(self):
+        v = [7, 1, 5, 3, 9]
+        self.assertAlmostEqual(1, percentile(v, 0))
+        self.assertAlmostEqual(4, percentile(v, 37.5))
+        self.assertAlmostEqual(9, percentile(v, 100))
+        self.assertAlmostEqual(5, percentile(iter(v), 50))
+        self.assertEqual([3, 5, 7], percentiles(v, [25, 50, 75]))
+
+    def test_percentiles_many(self):
+        v = [(i * 37) % 101 for i in range(101)]
+        ps = range(0, 101, 5)
+        for (p, x) in zip(ps, percentiles(v, ps)):
+            self.assertAlmostEqual(p, x)
+
+    def test_order_statistics(self):
+        v = [12, 13, 14, 15, 9, 10, 16, 10, 8, 10, 11, 12, 13, 22, 23, 24, 25]
+        stats = OrderStatistics(v)
+        self.assertEqual(17, stats.get_count())
+        self.assertEqual(8, stats.minimum())
+        self.assertEqual(25, stats.maximum())
+        self.assertAlmostEqual(13, stats.median())
+        self.assertAlmostEqual(interquartile_range(v), stats.interquartile_range())
+        self.assertAlmostEqual(trimean(v), stats.trimean())
+        self.assertAlmostEqual(trimean(v), trimean(stats))
+        self.assertAlmostEqual(percentile(v, 90), percentile(stats, 90))
+
 
     def test_correlation(self):
         x = [8, 9, 10, 12, 10, 13, 8, 7, 7, 12, 
@@ -168,6 +1291,237 @@ class TestStats(unittest.TestCase):
         r = correlation_coefficient(x, y)
         self.assertAlmostEqual(0.5427855, r)
 
+    def test_quantile_sketch_small_is_exact(self):
+        v = [12, 13, 14, 15, 9, 10, 16, 10, 8, 10, 11, 12, 13, 22, 23, 24, 25]
+        sketch = QuantileSketch(v)
+        self.assertEqual(17, sketch.get_count())
+        self.assertEqual(8, sketch.minimum())
+        self.assertEqual(25, sketch.maximum())
+        self.assertAlmostEqual(percentile(v, 37), percentile(sketch, 37))
+        self.assertAlmostEqual(trimean(v), trimean(sketch))
+        self.assertAlmostEqual(interquartile_range(v), interquartile_range(sketch))
+
+    def test_quantile_sketch_error_bound(self):
+        values = [(i * 7919) % 100000 for i in xrange(100000)]
+        sketch = QuantileSketch(k=200, seed=1)
+        for v in values[:50000]:
+            sketch.add(v)
+        sketch.add_many(values[50000:])
+        self.assertTrue(len(sketch.to_bytes()) < 8 * 1000)
+        self.assertEqual(0, sketch.minimum())
+        self.assertEqual(99999, sketch.maximum())
+        for p in [1, 10, 25, 50, 75, 90, 99]:
+            # the values are 0..99999, so a value is its own rank
+            self.assertTrue(abs(sketch.percentile(p) / 1000.0 - p) < 1.65)
+
+    def test_quantile_sketch_stream(self):
+        sketch = QuantileSketch(k=50)
+        sketch.BATCH_SIZE = 100
+        buffered = []
+        def stream():
+            for i in xrange(20000):
+                # Values are handed to the sketch as they're read,
+                # rather than all being read first.
+                buffered.append(i - sketch.get_count())
+                yield i
+        sketch.add_many(stream())
+        self.assertEqual(20000, sketch.get_count())
+        self.assertTrue(max(buffered) <= 3 * 50)
+
+    def test_quantile_sketch_merge_and_serialize(self):
+        sketches = [QuantileSketch(xrange(i, 30000, 3), seed=i) for i in range(3)]
+        merged = QuantileSketch(seed=4)
+        for sketch in sketches:
+            merged.merge(QuantileSketch.from_bytes(sketch.to_bytes()))
+        self.assertEqual(30000, merged.get_count())
+        self.assertEqual(0, merged.minimum())
+        self.assertEqual(29999, merged.maximum())
+        self.assertTrue(abs(merged.median() - 15000) < 300)
+
+    def test_moments(self):
+        v = [6, 11, 15, 12, 3, 14, 15, 15]
+        one_at_a_time = Moments()
+        for x in v:
+            one_at_a_time.add(x)
+        self.assertEqual(8, one_at_a_time.get_count())
+        self.assertAlmostEqual(11.375, one_at_a_time.mean())
+        self.assertAlmostEqual(4.5650066, one_at_a_time.standard_deviation())
+        merged = Moments(v[:3]).merge(Moments(v[3:]))
+        self.assertAlmostEqual(one_at_a_time.mean(), merged.mean())
+        self.assertAlmostEqual(one_at_a_time.variance(), merged.variance())
+        self.assertAlmostEqual(one_at_a_time.variance(), Moments().merge(merged).variance())
+
+    def test_moments_precision(self):
+        # The textbook sum-of-squares formula gets this badly wrong.
+        v = [1e9 + 4, 1e9 + 7, 1e9 + 13, 1e9 + 16]
+        self.assertAlmostEqual(30.0, Moments(v).variance())
+
+    def test_co_moments(self):
+        x = [8, 9, 10, 12, 10, 13, 8, 7, 7, 12]
+        y = [8, 10, 9, 12, 9, 11, 9, 10, 10, 12]
+        whole = CoMoments(x, y)
+        merged = CoMoments(x[:4], y[:4])
+        for (a, b) in zip(x[4:], y[4:]):
+            merged.add(a, b)
+        self.assertEqual(10, merged.get_count())
+        self.assertAlmostEqual(whole.covariance(), merged.covariance())
+        self.assertAlmostEqual(whole.correlation(), merged.correlation())
+        self.assertAlmostEqual(
+            whole.correlation(),
+            CoMoments(x[:5], y[:5]).merge(CoMoments(x[5:], y[5:])).correlation()
+            )
+
+    def test_bootstrap(self):
+        v = [6, 11, 15, 12, 3, 14, 15, 15, 9, 10, 7, 13]
+        (low, estimate, high) = bootstrap(mean, v, seed=1)
+        self.assertAlmostEqual(mean(v), estimate)
+        self.assertTrue(low < estimate < high)
+        self.assertEqual((low, estimate, high), bootstrap(mean, v, seed=1))
+        (low, estimate, high) = bootstrap(percentile, v, args=(90,), seed=1)
+        self.assertAlmostEqual(percentile(v, 90), estimate)
+        self.assertTrue(low <= estimate <= high)
+
+    def test_bootstrap_matches_unvectorized(self):
+        # A statistic that isn't in ROWWISE_STATISTICS is computed one
+        # resample at a time, and should get the same answer.
+        v = [6, 11, 15, 12, 3, 14, 15, 15, 9, 10, 7, 13]
+        def slow_trimean(values):
+            return trimean(list(values))
+        fast = bootstrap(trimean, v, replicates=200, seed=5)
+        slow = bootstrap(slow_trimean, v, replicates=200, seed=5)
+        for (a, b) in zip(fast, slow):
+            self.assertAlmostEqual(a, b)
+
+    def test_bootstrap_parallel(self):
+        x = [8, 9, 10, 12, 10, 13, 8, 7, 7, 12, 11, 11, 9, 13, 9]
+        y = [8, 10, 9, 12, 9, 11, 9, 10, 10, 12, 8, 11, 9, 11, 9]
+        saved = BOOTSTRAP_BATCH_VALUES
+        globals()['BOOTSTRAP_BATCH_VALUES'] = 300
+        try:
+            serial = bootstrap(correlation_coefficient, (x, y), seed=3)
+            parallel = bootstrap(correlation_coefficient, (x, y), seed=3, processes=2)
+        finally:
+            globals()['BOOTSTRAP_BATCH_VALUES'] = saved
+        self.assertEqual(serial, parallel)
+        self.assertAlmostEqual(correlation_coefficient(x, y), serial[1])
+
+    def test_moments_remove(self):
+        moments = Moments([6, 11, 15, 12, 3])
+        moments.remove(6)
+        moments.remove(11)
+        self.assertAlmostEqual(10, moments.mean())
+        self.assertAlmostEqual(Moments([15, 12, 3]).variance(), moments.variance())
+
+    def test_indexable_skiplist(self):
+        values = [(i * 37) % 101 for i in range(101)]
+        skiplist = IndexableSkiplist(len(values))
+        for v in values:
+            skiplist.insert(v)
+        for v in values[::2]:
+            skiplist.remove(v)
+        expected = sorted(values[1::2])
+        self.assertEqual(expected, list(skiplist))
+        self.assertEqual(expected, [skiplist[i] for i in range(len(skiplist))])
+        self.assertEqual(expected[-1], skiplist[-1])
+        self.assertRaises(KeyError, skiplist.remove, 1000)
+
+    def test_indexable_skiplist_grows(self):
+        skiplist = IndexableSkiplist(4)
+        values = [(i * 7919) % 5000 for i in range(5000)]
+        for v in values:
+            skiplist.insert(v)
+        self.assertTrue(13 <= skiplist.max_levels)
+        for v in values[::3]:
+            skiplist.remove(v)
+        expected = sorted(set(values) - set(values[::3]))
+        self.assertEqual(expected, list(skiplist))
+        self.assertEqual(expected[1234], skiplist[1234])
+
+    def test_rolling_window_size(self):
+        values = [6, 11, 15, 12, 3, 14, 15, 15, 9, 10, 7, 13]
+        window = RollingWindow(size=5)
+        for (i, v) in enumerate(values):
+            window.push(v)
+            expected = values[max(0, i - 4):i + 1]
+            self.assertEqual(expected, window.get_values())
+            self.assertAlmostEqual(mean(expected), window.mean())
+            self.assertAlmostEqual(percentile(expected, 75), window.percentile(75))
+            self.assertEqual(min(expected), window.minimum())
+        self.assertAlmostEqual(standard_deviation(values[-5:]), window.standard_deviation())
+        self.assertAlmostEqual(trimean(values[-5:]), trimean(window))
+        window.advance(1000)
+        self.assertEqual(values[-5:], window.get_values())
+
+    def test_rolling_window_turns_constant(self):
+        window = RollingWindow(size=2)
+        for v in [1e8, 1e8 + 1, 1e8 + 1]:
+            window.push(v)
+        self.assertEqual(0.0, window.standard_deviation())
+        rand = random.Random(7)
+        for trial in range(20):
+            window = RollingWindow(size=10)
+            for i in range(50):
+                window.push(rand.uniform(100, 200))
+            for i in range(10):
+                window.push(123.456)
+                window.standard_deviation()
+            self.assertTrue(window.standard_deviation() < 1e-6)
+            for i in range(10):
+                window.push(123.456)
+            self.assertEqual(0.0, window.standard_deviation())
+            self.assertEqual(123.456, window.mean())
+
+    def test_rolling_window_spike(self):
+        rand = random.Random(3)
+        window = RollingWindow(size=1000, order_statistics=False)
+        for i in range(1000):
+            window.push(rand.gauss(100, 1))
+        window.push(1e8)
+        for i in range(1100):
+            window.push(rand.gauss(100, 1))
+            if 999 <= i:
+                # The spike is gone.
+                expected = standard_deviation(window.get_values())
+                self.assertTrue(abs(window.standard_deviation() - expected) < 1e-9 * expected)
+        window.push(1e8)
+        for i in range(1000):
+            window.push(5.0)
+        self.assertEqual(0.0, window.standard_deviation())
+
+    def test_rolling_window_duration(self):
+        window = RollingWindow(duration=10, order_statistics=False)
+        for t in range(20):
+            window.push(t * t, timestamp=t)
+        self.assertEqual([t * t for t in range(10, 20)], window.get_values())
+        window.advance(25)
+        self.assertEqual([256, 289, 324, 361], window.get_values())
+        self.assertAlmostEqual(mean([256, 289, 324, 361]), window.mean())
+        self.assertRaises(ValueError, window.percentile, 50)
+
+    def test_weighted(self):
+        values_and_counts = [(3, 2), (1, 6221), (250, 131), (2, 0), (20, 124), (7, 47)]
+        expanded = [v for (v, c) in values_and_counts for i in xrange(c)]
+        (values, counts) = zip(*values_and_counts)
+        self.assertAlmostEqual(mean(expanded), weighted_mean(values_and_counts))
+        self.assertAlmostEqual(mean(expanded), weighted_mean(values, weights=counts))
+        self.assertAlmostEqual(
+            standard_deviation(expanded),
+            weighted_standard_deviation(values_and_counts)
+            )
+        for p in [0, 10, 50, 95, 97.5, 99, 100]:
+            self.assertAlmostEqual(percentile(expanded, p), weighted_percentile(values_and_counts, p))
+            self.assertAlmostEqual(percentile(expanded, p), weighted_percentile(values, p, weights=counts))
+        self.assertAlmostEqual(trimean(expanded), weighted_trimean(values_and_counts))
+        self.assertAlmostEqual(
+            interquartile_range(expanded),
+            weighted_interquartile_range(values, weights=counts)
+            )
+        stats = WeightedOrderStatistics(values_and_counts)
+        self.assertEqual(len(expanded), stats.get_count())
+        self.assertEqual(1, stats.minimum())
+        self.assertEqual(250, stats.maximum())
+        self.assertAlmostEqual(percentile(expanded, 96), percentile(stats, 96))
+
     def test_factorial(self):
         self.assertEqual(120, factorial(5))
 
@@ -178,12 +1532,33 @@ class TestStats(unittest.TestCase):
         self.assertAlmostEqual(0.36, binomial_probability(2, 0, 0.4))
         self.assertAlmostEqual(0.0546875, binomial_probabilities(10, [8, 9, 10], 0.5))
 
+    def test_binomial_probability_vectorized(self):
+        pmf = binomial_probability(10, numpy.arange(11), 0.3)
+        self.assertEqual((11,), pmf.shape)
+        self.assertAlmostEqual(1.0, pmf.sum())
+        self.assertAlmostEqual(binomial_probability(10, 3, 0.3), pmf[3])
+        self.assertAlmostEqual(0.0, binomial_probability(10, 11, 0.3))
+        self.assertAlmostEqual(1.0, binomial_probability(10, 10, 1.0))
+        # Stirling: the middle of a big fair binomial is sqrt(2 / (pi N))
+        self.assertAlmostEqual(
+            math.sqrt(2.0 / (math.pi * 1e6)),
+            binomial_probability(1000000, 500000, 0.5),
+            places=9
+            )
+
     def test_poisson_probability(self):
         self.assertAlmostEqual(0.0116442, poisson_probability(21, 12))
+        self.assertAlmostEqual(1.0, poisson_probability(0.0, 0))
+        pmf = poisson_probability([21, 21], [12, 13])
+        self.assertAlmostEqual(0.0116442, pmf[0])
+        self.assertAlmostEqual(poisson_probability(21, 13), pmf[1])
 
     def test_multinomial_probability(self):
         # http://onlinestatbook.com/2/probability/multinomial.html
         self.assertAlmostEqual(0.1008, multinomial_probability([0.4, 0.1, 0.5], [4, 1, 5]))
+        both = multinomial_probability([0.4, 0.1, 0.5], [[4, 1, 5], [10, 0, 0]])
+        self.assertAlmostEqual(0.1008, both[0])
+        self.assertAlmostEqual(0.4 ** 10, both[1])
 
     def test_bayes(self):
         self.assertAlmostEqual(0.4049587, bayes(0.98, 0.06, 0.04))
@@ -203,7 +1578,47 @@ class TestStats(unittest.TestCase):
         self.assertAlmostEqual(0.0, low)
         self.assertAlmostEqual(0.0, rate)
         self.assertAlmostEqual(0.0092222, high)
-        
+
+        # Not a number in, not a number out
+        for x in [float('nan'), float('inf')]:
+            (low, rate, high) = poisson_confidence_interval(x, 400)
+            self.assertTrue(math.isnan(low) and math.isnan(high))
+
+    def test_poisson_quantile_cache(self):
+        poisson_quantile_cache.clear()
+        first = poisson_confidence_interval(14, 400)
+        second = poisson_confidence_interval(14, 800)
+        self.assertAlmostEqual(first[2], second[2] * 2)
+        poisson_confidence_interval(14, 400, 0.99)
+        info = poisson_quantile_cache.get_info()
+        self.assertEqual(1, info['hits'])
+        self.assertEqual(2, info['misses'])
+        self.assertEqual(2, info['size'])
+
+    def test_bounded_cache(self):
+        cache = BoundedCache(2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        self.assertEqual(1, cache.get('a', lambda: 99))
+        cache.get('c', lambda: 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(22, cache.get('b', lambda: 22))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(4, cache.misses)
+
+    def test_poisson_confidence_intervals(self):
+        (low, rate, high) = poisson_confidence_intervals([14, 0, 14], [400, 400, 800])
+        self.assertEqual((3,), low.shape)
+        for (i, (n, size)) in enumerate([(14, 400), (0, 400), (14, 800)]):
+            expected = poisson_confidence_interval(n, size)
+            self.assertAlmostEqual(expected[0], low[i])
+            self.assertAlmostEqual(expected[1], rate[i])
+            self.assertAlmostEqual(expected[2], high[i])
+        (low, rate, high) = poisson_confidence_intervals(14, 400, [0.95, 0.99])
+        self.assertAlmostEqual(0.0191348, low[0])
+        self.assertAlmostEqual(poisson_confidence_interval(14, 400, 0.99)[2], high[1])
+        self.assertRaises(Exception, poisson_confidence_intervals, [1, 2], [400, 0])
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -21,14 +21,36 @@ the same keys.  You can think of it as a table, where each key is a
 column, and each of the dicts is a row.
 
 STRUCTURE: Columns
+
+The same data can be held as one sequence per column, where all of the
+sequences are the same length.  This takes much less memory for big
+tables: a column of numbers can be an array.array (or a numpy array)
+rather than a list of boxed Python objects, and the column names
+aren't repeated in every row.  See the Columns class.
 """
 
+import array
+import bisect
+import csv
+import heapq
 import itertools
+import json
 import math
+import mmap
+import numbers
+import os
+import operator
+import StringIO
+import struct
+import sys
+import tempfile
 import unittest
 
 from collections import Counter
 
+from .bstat import Moments, QuantileSketch, percentile
+from .lazy import numpy
+
 def log2(x):
     return math.log(x) / math.log(2)
 
@@ -55,6 +77,29 @@ def round_up_to_nice(x, tolerance=None):
             return result
         quantum /= divisor
 
+def round_up_to_nice_array(x, tolerance=None):
+    """
+    The same as round_up_to_nice, but for a whole numpy array of
+    numbers at once.  Returns a numpy array of the results.
+    """
+    x = numpy.asarray(x, dtype=float)
+    if tolerance is None:
+        tolerance = numpy.abs(x / 10.0)
+    tolerance = numpy.broadcast_to(numpy.asarray(tolerance, dtype=float), x.shape)
+    result = x.copy()
+    pending = (x != 0) & (tolerance != 0)
+    quantum = numpy.ones(x.shape)
+    quantum[pending] = numpy.power(10.0, numpy.ceil(numpy.log10(tolerance[pending])))
+    for divisor in itertools.cycle([2, 5]):
+        if not pending.any():
+            return result
+        rounded = numpy.ceil(x[pending] / quantum[pending]) * quantum[pending]
+        close = (rounded - x[pending] <= tolerance[pending])
+        done = numpy.flatnonzero(pending)[close]
+        result[done] = rounded[close]
+        pending[done] = False
+        quantum[pending] /= divisor
+
 def round_down_to_nice(x, tolerance=None):
     """
     Given a number, round it down to a 'nice' number that is 'close'.
@@ -122,9 +167,31 @@ class TestUtilities(unittest.TestCase):
         self.assertEqual(2, nearest(1.8, [1, 2, 3]))
         self.assertEqual(2, nearest(2.4, [1, 2, 3]))
         
+    def test_round_up_to_nice_array(self):
+        values = [85, 11.8, 0.799, 0.8, -1.1, -0.799, 0, 1.1 ** 40, 123456.789, 3e-7]
+        self.assertEqual(
+            [round_up_to_nice(x) for x in values],
+            round_up_to_nice_array(values).tolist()
+            )
+        self.assertEqual(
+            [round_up_to_nice(x, 0.3) for x in values],
+            round_up_to_nice_array(values, 0.3).tolist()
+            )
+
     def round_to_nice(self):
         self.assertAlmostEqual(3.1, round_to_nice(math.pi))
 
+def _as_numpy_array(values):
+    """
+    Returns the values as a numpy array, without copying them if
+    they're already in a numpy array or an array.array.
+    """
+    if isinstance(values, array.array):
+        return numpy.frombuffer(values, dtype=values.typecode)
+    if not hasattr(values, '__len__'):
+        values = list(values)
+    return numpy.asarray(values)
+
 class AutoBins(object):
 
     """
@@ -142,6 +209,9 @@ class AutoBins(object):
     pairs.  This is equivalent to the one above:
 
         [(0, 1), (1, 2), (2, 5), (4, 1), (5, 1), (6,1)]
+
+    The values can also be a numpy array or an array.array, which is
+    much faster and smaller for big data sets.
     """
 
     def __init__(self, values=None, values_and_counts=None, bin_count=None):
@@ -151,27 +221,36 @@ class AutoBins(object):
         if (values is not None) and (values_and_counts is not None):
             raise ValueError('Only one of values or values_and_counts should be set')
 
-        # Make sure that both values and values_and_counts are set
+        # Summarize the values: the range, the total count, and a way
+        # to count how many fall below a given number.  This is done
+        # with numpy, without building a Python object per value.
         if values_and_counts is None:
-            values_and_counts = [(v, c) for (v, c) in Counter(values).iteritems()]
-        values = set(v for (v,c) in values_and_counts)
-        total_count = sum(c for (v,c) in values_and_counts)
+            values = _as_numpy_array(values)
+            total_count = len(values)
+            def count_below(x):
+                return int(numpy.count_nonzero(values < x))
+        else:
+            pairs = numpy.asarray(list(values_and_counts)).reshape(-1, 2)
+            values = pairs[:, 0]
+            counts = pairs[:, 1]
+            total_count = counts.sum().item()
+            def count_below(x):
+                return counts[values < x].sum().item()
+        low = values.min().item()
+        high = values.max().item()
 
         # With a single value, it's a degenerate case.
-        if len(values) == 1:
-            value = values_and_counts[0][0]
-            self.lower_bound = value
+        if low == high:
+            self.lower_bound = low
             self.bin_size = 0
             self.bin_count = 1
-            self.bin_boundaries = [value, value]
+            self.bin_boundaries = [low, low]
             self.logarithmic = False
             return
 
         # Figure out the number of bins.
         # This is Sturges's rule from: 
         # http://onlinestatbook.com/2/graphing_distributions/histograms.html
-        low = min(values)
-        high = max(values)
         span = float(high - low)
         if bin_count is None:
             bin_count = 1 + round(log2(total_count))
@@ -208,11 +287,7 @@ class AutoBins(object):
 
         # Should we switch to logarithmic?  If more than half the
         # values are NOT in the first bin, then we're good.
-        number_in_first_bucket = sum(
-            c
-            for (v,c) in values_and_counts
-            if v < bin_boundaries[1]
-            )
+        number_in_first_bucket = count_below(bin_boundaries[1])
         self.logarithmic = (
             0 < low and
             (total_count / 2 < number_in_first_bucket)
@@ -236,11 +311,69 @@ class AutoBins(object):
         bucket_exponent = round_up_to_nice(total_growth ** (1.0 / b))
         
         self.lower_bound = lower_bound
+        self.bin_size = None
         self.bin_count = bin_count
-        self.bin_boundaries = [
-            round_up_to_nice(lower_bound * (bucket_exponent ** i))
-            for i in xrange(bin_count + 1)
-            ]
+        self.bin_boundaries = round_up_to_nice_array(
+            lower_bound * (bucket_exponent ** numpy.arange(bin_count + 1))
+            ).tolist()
+
+    @classmethod
+    def from_bin_boundaries(cls, bin_boundaries, logarithmic=False):
+        """
+        Makes bins with the given boundaries, rather than picking them
+        from the data.
+        """
+        bin_boundaries = list(bin_boundaries)
+        if len(bin_boundaries) < 2:
+            raise ValueError('need at least two bin boundaries')
+        result = cls.__new__(cls)
+        result.lower_bound = bin_boundaries[0]
+        result.bin_count = len(bin_boundaries) - 1
+        result.bin_boundaries = bin_boundaries
+        result.logarithmic = logarithmic
+        result.bin_size = None
+        if not logarithmic:
+            # If they're evenly spaced, bin lookup can use arithmetic.
+            size = float(bin_boundaries[1] - bin_boundaries[0])
+            tolerance = abs(size) * 1e-9
+            if all(abs((b - bin_boundaries[0]) - i * size) <= tolerance * i
+                   for (i, b) in enumerate(bin_boundaries)):
+                result.bin_size = size
+        return result
+
+    def extended(self, low, high):
+        """
+        Returns a pair (bins, added_below): new bins that cover the
+        range from low to high, and the number of bins added below the
+        existing ones.  The existing boundaries are all kept, so counts
+        for the existing bins carry over unchanged.
+
+        Each new linear bin is twice as wide as the one next to it,
+        and each new logarithmic bin grows by the same factor as the
+        bins next to it, so even a far-away value only adds a few
+        bins.  Logarithmic bins can't be extended down to zero or
+        below.
+        """
+        b = list(self.bin_boundaries)
+        if b[0] == b[-1]:
+            # Degenerate bins around a single value.
+            if high != b[-1]:
+                b[-1] = high
+            elif low != b[0]:
+                b[0] = low
+        added_below = 0
+        while b[-1] < high:
+            if self.logarithmic:
+                b.append(round_up_to_nice(b[-1] * b[-1] / float(b[-2])))
+            else:
+                b.append(round_up_to_nice(b[-1] + 2 * (b[-1] - b[-2])))
+        while low < b[0] and (0 < low or not self.logarithmic):
+            if self.logarithmic:
+                b.insert(0, round_down_to_nice(b[0] * b[0] / float(b[1])))
+            else:
+                b.insert(0, round_down_to_nice(b[0] - 2 * (b[1] - b[0])))
+            added_below += 1
+        return (AutoBins.from_bin_boundaries(b, self.logarithmic), added_below)
 
     def is_logarithmic(self):
         return self.logarithmic
@@ -256,10 +389,41 @@ class AutoBins(object):
         return self.bin_boundaries
 
     def get_bin_index_for_value(self, value):
-        for i in xrange(self.bin_count):
-            if value < self.bin_boundaries[i+1]:
-                return i
-        return self.bin_count - 1
+        """
+        Returns the index of the bin that holds the value.  Values
+        below the range go in the first bin, and values above it go
+        in the last bin.
+        """
+        last = self.bin_count - 1
+        if self.bin_size:
+            # Linear bins: compute the index directly, and then fix it
+            # up in case rounding put it in a neighboring bin.
+            position = (value - self.lower_bound) / self.bin_size
+            if not (0 <= position < self.bin_count):
+                return 0 if position < 0 else last
+            i = int(position)
+            if i < last and self.bin_boundaries[i + 1] <= value:
+                i += 1
+            elif 0 < i and value < self.bin_boundaries[i]:
+                i -= 1
+            return i
+        else:
+            # Logarithmic bins have rounded boundaries, so search them.
+            i = bisect.bisect_right(self.bin_boundaries, value) - 1
+            return max(0, min(i, last))
+
+    def get_bin_indices_for_values(self, values):
+        """
+        Returns a numpy array with the bin index for each of the values,
+        computed all at once.  The answers are the same as
+        get_bin_index_for_value.
+        """
+        indices = numpy.searchsorted(
+            self.bin_boundaries,
+            numpy.asarray(values, dtype=float),
+            side='right'
+            ) - 1
+        return numpy.clip(indices, 0, self.bin_count - 1)
 
     def __str__(self):
         return "<bins %s>" % (", ".join(str(b) for b in self.bin_boundaries))
@@ -446,19 +610,383 @@ class TestAutoBins(unittest.TestCase):
         bins = AutoBins(values_and_counts=values_and_counts)
         self.assertTrue(bins.is_logarithmic())
 
+    def check_same_bins(self, values):
+        expected = AutoBins(list(values))
+        for other in [AutoBins(numpy.array(values)),
+                      AutoBins(array.array('d', values)),
+                      AutoBins(iter(values)),
+                      AutoBins(values_and_counts=Counter(values).items())]:
+            self.assertEqual(expected.get_bin_boundaries(), other.get_bin_boundaries())
+            self.assertEqual(expected.is_logarithmic(), other.is_logarithmic())
+
+    def test_array_inputs(self):
+        self.check_same_bins([1.2 + i/5.0 for i in range(16)])
+        self.check_same_bins([1.1 ** i for i in range(100)])
+        self.check_same_bins([float(i * i % 1000) for i in range(5000)])
+        self.check_same_bins([3.0])
+
+    def check_bin_indices(self, bins, values):
+        # The answers should match a linear scan of the boundaries.
+        boundaries = bins.get_bin_boundaries()
+        def slow_index(value):
+            for i in xrange(bins.get_bin_count()):
+                if value < boundaries[i + 1]:
+                    return i
+            return bins.get_bin_count() - 1
+        expected = [slow_index(v) for v in values]
+        self.assertEqual(expected, [bins.get_bin_index_for_value(v) for v in values])
+        self.assertEqual(expected, bins.get_bin_indices_for_values(values).tolist())
+
+    def test_bin_index_linear(self):
+        values = [1.2 + i/5.0 for i in range(16)]
+        bins = AutoBins(values)
+        self.check_bin_indices(bins, values + bins.get_bin_boundaries() + [-5, 0.75, 100])
+
+    def test_bin_index_logarithmic(self):
+        values = [1.1 ** i for i in range(100)]
+        bins = AutoBins(values)
+        self.check_bin_indices(bins, values + bins.get_bin_boundaries() + [0, 1e9])
+
+    def test_bin_index_single_value(self):
+        self.check_bin_indices(AutoBins([1]), [0, 1, 2])
+
+class LogLinearBins(AutoBins):
+
+    """
+    Fixed bins in the style of HdrHistogram, which don't depend on the
+    data, and which keep the relative error of every bin below a
+    given number of significant digits.  Good for latencies, which
+    can range from microseconds to minutes.
+
+    From 0 up to sub_bucket_count * lowest, the bins are lowest wide.
+    After that, each power of two is split into sub_bucket_count / 2
+    equal bins.  Above (sub_bucket_count / 2) * lowest, which is
+    about 10**significant_digits * lowest, each bin's width is less
+    than 10**-significant_digits times its lower edge.  Finding a
+    value's bin is O(1).
+
+    The bins are extended with more powers of two, as needed, to hold
+    values above highest.  Negative values go in the first bin.
+    """
+
+    def __init__(self, lowest, highest, significant_digits=2):
+        self.lowest = float(lowest)
+        self.highest = highest
+        self.significant_digits = significant_digits
+        self.sub_bucket_bits = int(math.ceil(log2(2 * 10 ** significant_digits)))
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.half_count = self.sub_bucket_count // 2
+
+        # Each level k covers [half * 2**k, half * 2**(k+1)) * lowest.
+        levels = 0
+        while self.half_count * (2 ** (levels + 1)) * self.lowest < highest:
+            levels += 1
+        bin_boundaries = [i * self.lowest for i in xrange(self.sub_bucket_count + 1)]
+        for k in xrange(1, levels + 1):
+            bin_boundaries.extend(
+                (self.half_count + j) * (2 ** k) * self.lowest
+                for j in xrange(1, self.half_count + 1)
+                )
+
+        self.lower_bound = 0.0
+        self.bin_size = None
+        self.bin_count = len(bin_boundaries) - 1
+        self.bin_boundaries = bin_boundaries
+        self.logarithmic = True
+
+    def get_bin_index_for_value(self, value):
+        u = value / self.lowest
+        if u < self.sub_bucket_count:
+            return self._fix_index(max(0, int(u)), value)
+        (mantissa, exponent) = math.frexp(u)
+        k = exponent - self.sub_bucket_bits
+        index = (
+            self.sub_bucket_count + (k - 1) * self.half_count +
+            int(math.ldexp(u, -k)) - self.half_count
+            )
+        return self._fix_index(min(index, self.bin_count - 1), value)
+
+    def _fix_index(self, index, value):
+        # When lowest isn't exact in binary, like 0.1, dividing by it
+        # can put a value on a boundary in the neighboring bin.  Fix it
+        # up so it agrees with the boundaries.
+        last = self.bin_count - 1
+        if index < last and self.bin_boundaries[index + 1] <= value:
+            return index + 1
+        if 0 < index and value < self.bin_boundaries[index]:
+            return index - 1
+        return index
+
+    def get_bin_indices_for_values(self, values):
+        values = numpy.asarray(values, dtype=float)
+        u = values / self.lowest
+        (mantissa, exponent) = numpy.frexp(u)
+        k = numpy.maximum(exponent - self.sub_bucket_bits, 1)
+        large = (
+            self.sub_bucket_count + (k - 1) * self.half_count +
+            numpy.floor(numpy.ldexp(u, -k)).astype(int) - self.half_count
+            )
+        small = numpy.floor(numpy.clip(u, 0, self.sub_bucket_count)).astype(int)
+        indices = numpy.where(u < self.sub_bucket_count, small, large)
+        indices = numpy.clip(indices, 0, self.bin_count - 1)
+
+        # The same fix-up as in get_bin_index_for_value.
+        last = self.bin_count - 1
+        bin_boundaries = numpy.asarray(self.bin_boundaries)
+        indices += (indices < last) & (bin_boundaries[numpy.minimum(indices + 1, last)] <= values)
+        indices -= (0 < indices) & (values < bin_boundaries[indices])
+        return indices
+
+    def get_octave_boundaries(self):
+        """
+        Returns a subset of the bin boundaries: one for each power of
+        two, starting at lowest, plus 0 at the beginning.
+        """
+        result = [0.0]
+        b = self.lowest
+        while b <= self.bin_boundaries[-1]:
+            result.append(b)
+            b *= 2
+        return result
+
+    def extended(self, low, high):
+        if high <= self.bin_boundaries[-1]:
+            return (self, 0)
+        return (LogLinearBins(self.lowest, high, self.significant_digits), 0)
+
+class TestLogLinearBins(unittest.TestCase):
+
+    def test_boundaries(self):
+        bins = LogLinearBins(1, 1000, significant_digits=1)
+        self.assertEqual(32, bins.sub_bucket_count)
+        bin_boundaries = bins.get_bin_boundaries()
+        self.assertEqual(range(33), bin_boundaries[:33])
+        self.assertEqual([34, 36, 38], bin_boundaries[33:36])
+        self.assertTrue(1000 <= bin_boundaries[-1] < 2000)
+        self.assertTrue(bins.is_logarithmic())
+        for (low, high) in zip(bin_boundaries[16:], bin_boundaries[17:]):
+            self.assertTrue((high - low) / low <= 0.1)
+
+    def test_bin_index(self):
+        bins = LogLinearBins(0.5, 1e6, significant_digits=2)
+        bin_boundaries = bins.get_bin_boundaries()
+        values = [-1, 0, 0.3, 1, 127.9, 128, 129, 1000, 12345.6, 999999, 5e6]
+        values += bin_boundaries[::97]
+        expected = [
+            max(0, min(bisect.bisect_right(bin_boundaries, v) - 1, bins.get_bin_count() - 1))
+            for v in values
+            ]
+        self.assertEqual(expected, [bins.get_bin_index_for_value(v) for v in values])
+        self.assertEqual(expected, bins.get_bin_indices_for_values(values).tolist())
+
+    def test_bin_index_inexact_lowest(self):
+        for lowest in [0.1, 1e-6]:
+            bins = LogLinearBins(lowest, 1e5 * lowest, significant_digits=2)
+            bin_boundaries = bins.get_bin_boundaries()
+            values = bin_boundaries + [b * (1 + 1e-15) for b in bin_boundaries]
+            expected = [
+                max(0, min(bisect.bisect_right(bin_boundaries, v) - 1, bins.get_bin_count() - 1))
+                for v in values
+                ]
+            self.assertEqual(expected, [bins.get_bin_index_for_value(v) for v in values])
+            self.assertEqual(expected, bins.get_bin_indices_for_values(values).tolist())
+
+def _apportion(total, weights):
+    """
+    Splits the whole number total into whole-number shares, in
+    proportion to the weights, using the largest remainder method so
+    that the shares add up to the total.
+    """
+    weight_sum = float(sum(weights))
+    exact = [total * w / weight_sum for w in weights]
+    shares = [int(math.floor(x)) for x in exact]
+    leftover = total - sum(shares)
+    by_remainder = sorted(xrange(len(exact)), key=lambda i: shares[i] - exact[i])
+    for i in by_remainder[:leftover]:
+        shares[i] += 1
+    return shares
+
 class Histogram(object):
 
-    def __init__(self, name, values):
+    """
+    Counts how many values fall into each of a set of bins, and
+    displays the result.
+
+    Given a list of values, picks bins for them with AutoBins:
+
+        Histogram('latency', values)
+
+    Values can also be added one at a time, or in batches, with add()
+    and add_many().  To start with bins fixed ahead of time, pass them
+    in, and leave out the values:
+
+        Histogram('latency', bins=AutoBins(warm_up_sample))
+
+    The values themselves are not kept, just the counts.  If a value
+    falls outside the range of the bins, more bins are added to cover
+    it; see AutoBins.extended.
+    """
+
+    def __init__(self, name, values=None, bins=None):
+        if (values is None) and (bins is None):
+            raise ValueError('Either values or bins should be set')
         self.name = name
-        self.values = values
-        self.bins = AutoBins(values)
+        if bins is None:
+            # The bins are made to fit the values, so no need to
+            # check the range.  The values are looked at twice, so an
+            # iterator has to be read into an array first.
+            values = _as_numpy_array(values)
+            self.bins = AutoBins(values)
+            indices = self.bins.get_bin_indices_for_values(values)
+            self.counts = numpy.bincount(indices, minlength=self.bins.get_bin_count()).tolist()
+        else:
+            self.bins = bins
+            self.counts = self._make_counts(bins.get_bin_count())
+            if values is not None:
+                self.add_many(values)
 
-        # Count the values in each bin
-        bin_count = self.bins.get_bin_count()
-        self.counts = [0] * bin_count
-        for v in values:
-            bin_index = self.bins.get_bin_index_for_value(v)
-            self.counts[bin_index] += 1
+    def _make_counts(self, bin_count):
+        return [0] * bin_count
+
+    def _cover(self, low, high):
+        """
+        Makes sure the bins cover the range from low to high.
+        """
+        bin_boundaries = self.bins.get_bin_boundaries()
+        if bin_boundaries[0] <= low and high <= bin_boundaries[-1]:
+            return
+        (bins, added_below) = self.bins.extended(low, high)
+        if bins is self.bins:
+            # Bins that can't grow, like LogLinearBins below zero, put
+            # the values in the end bins instead.
+            return
+        counts = self._make_counts(bins.get_bin_count())
+        counts[added_below:added_below + len(self.counts)] = self.counts
+        self.bins = bins
+        self.counts = counts
+
+    def add(self, value):
+        self._cover(value, value)
+        self.counts[self.bins.get_bin_index_for_value(value)] += 1
+
+    def add_many(self, values):
+        values = _as_numpy_array(values)
+        if len(values) == 0:
+            return
+        self._cover(values.min().item(), values.max().item())
+        indices = self.bins.get_bin_indices_for_values(values)
+        added = numpy.bincount(indices, minlength=self.bins.get_bin_count())
+        for i in numpy.flatnonzero(added):
+            self.counts[i] += int(added[i])
+
+    def get_total_count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """
+        Estimates the p-th percentile from the counts, as the middle
+        of the bin that holds it.  The error is no more than half the
+        width of that bin.
+        """
+        total = self.get_total_count()
+        if total == 0:
+            raise ValueError('no values')
+        rank = (p / 100.0) * (total - 1)
+        bin_boundaries = self.bins.get_bin_boundaries()
+        cumulative = 0
+        for (i, count) in enumerate(self.counts):
+            cumulative += count
+            if rank < cumulative:
+                return (bin_boundaries[i] + bin_boundaries[i + 1]) / 2.0
+
+    def merge(self, other):
+        """
+        Adds the counts from another histogram into this one.  If the
+        two have the same bins, this is exact.  Otherwise, this
+        histogram's bins are extended to cover the other's range, and
+        each of the other's counts is spread over the bins it
+        overlaps, in proportion to the overlap.
+        """
+        if self.bins.get_bin_boundaries() == other.bins.get_bin_boundaries():
+            for (i, count) in enumerate(other.counts):
+                self.counts[i] += count
+            return self
+        other_boundaries = other.bins.get_bin_boundaries()
+        self._cover(other_boundaries[0], other_boundaries[-1])
+        target = self.bins.get_bin_boundaries()
+        for (i, count) in enumerate(other.counts):
+            if count == 0:
+                continue
+            (low, high) = (other_boundaries[i], other_boundaries[i + 1])
+            first = self.bins.get_bin_index_for_value(low)
+            last = max(first, min(bisect.bisect_left(target, high) - 1, len(self.counts) - 1))
+            if first == last:
+                self.counts[first] += count
+                continue
+            overlaps = [
+                min(high, target[j + 1]) - max(low, target[j])
+                for j in xrange(first, last + 1)
+                ]
+            for (j, share) in enumerate(_apportion(count, overlaps)):
+                self.counts[first + j] += share
+        return self
+
+    MAGIC = 'BHS1'
+    HEADER = struct.Struct('<4sBHI')
+
+    # Flags in the header
+    LOGARITHMIC = 1
+    LOG_LINEAR = 2
+    LOG_LINEAR_PARAMETERS = struct.Struct('<ddI')
+
+    def _get_flags(self):
+        return self.LOGARITHMIC if self.bins.is_logarithmic() else 0
+
+    def _get_extra_bytes(self):
+        return ''
+
+    def to_bytes(self):
+        """
+        Returns a compact binary form of the histogram: a header, the
+        name, anything else a subclass needs to rebuild its bins, the
+        bin boundaries as doubles, and the counts as 64-bit integers.
+        """
+        name = self.name.encode('utf-8') if isinstance(self.name, unicode) else self.name
+        bin_boundaries = self.bins.get_bin_boundaries()
+        return ''.join([
+            self.HEADER.pack(
+                self.MAGIC,
+                self._get_flags(),
+                len(name),
+                len(self.counts)
+                ),
+            name,
+            self._get_extra_bytes(),
+            struct.pack('<%dd' % len(bin_boundaries), *bin_boundaries),
+            struct.pack('<%dQ' % len(self.counts), *self.counts)
+            ])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Rebuilds a histogram from to_bytes().  A LogLinearHistogram
+        comes back as a LogLinearHistogram.
+        """
+        (magic, flags, name_length, bin_count) = cls.HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC:
+            raise ValueError('not a serialized Histogram')
+        if flags & cls.LOG_LINEAR:
+            return LogLinearHistogram.from_bytes(data)
+        offset = cls.HEADER.size
+        name = data[offset:offset + name_length]
+        offset += name_length
+        bin_boundaries = struct.unpack_from('<%dd' % (bin_count + 1), data, offset)
+        offset += 8 * (bin_count + 1)
+        counts = struct.unpack_from('<%dQ' % bin_count, data, offset)
+        bins = AutoBins.from_bin_boundaries(bin_boundaries, logarithmic=(flags & cls.LOGARITHMIC != 0))
+        result = Histogram(name, bins=bins)
+        result.counts = list(counts)
+        return result
 
     def __str__(self):
         # Figure out the scale-down factor (if needed) for an
@@ -495,6 +1023,77 @@ class Histogram(object):
 
 class TestHistogram(unittest.TestCase):
 
+    def test_streaming(self):
+        values = [28, 27, 27, 24, 27, 24, 28, 27, 26, 27, 28, 25, 25]
+        all_at_once = Histogram('test', values)
+        h = Histogram('test', bins=AutoBins(values))
+        for v in values[:5]:
+            h.add(v)
+        h.add_many(values[5:])
+        self.assertFalse(hasattr(h, 'values'))
+        self.assertEqual(all_at_once.counts, h.counts)
+        self.assertEqual(str(all_at_once), str(h))
+        from_generator = Histogram('test', (v for v in values))
+        self.assertEqual(all_at_once.counts, from_generator.counts)
+
+    def test_extend_linear(self):
+        h = Histogram('test', bins=AutoBins.from_bin_boundaries([0, 10, 20, 30]))
+        h.add_many([5, 15, 25, 25])
+        h.add(95)
+        h.add(-12)
+        bin_boundaries = h.bins.get_bin_boundaries()
+        self.assertEqual([-20, 0, 10, 20, 30, 50, 90, 170], bin_boundaries)
+        self.assertEqual([1, 1, 1, 2, 0, 0, 1], h.counts)
+        self.assertEqual(6, h.get_total_count())
+
+    def test_extend_logarithmic(self):
+        bins = AutoBins([1.1 ** i for i in range(100)])
+        h = Histogram('test', bins=bins)
+        h.add_many([10, 1e6, 0.1])
+        h.add(-1)
+        bin_boundaries = h.bins.get_bin_boundaries()
+        self.assertTrue(bin_boundaries[0] <= 0.1 < bin_boundaries[1])
+        self.assertTrue(1e6 <= bin_boundaries[-1])
+        self.assertTrue(len(bin_boundaries) < 20)
+        self.assertEqual(2, h.counts[0])
+        self.assertEqual(1, h.counts[-1])
+
+    def test_merge_same_bins(self):
+        bins = AutoBins.from_bin_boundaries([0, 10, 20, 30])
+        a = Histogram('a', [1, 2, 15], bins=bins)
+        b = Histogram('b', [25, 29, 15], bins=bins)
+        a.merge(b)
+        self.assertEqual([2, 2, 2], a.counts)
+
+    def test_merge_different_bins(self):
+        a = Histogram('a', [5, 15, 25], bins=AutoBins.from_bin_boundaries([0, 10, 20, 30]))
+        b = Histogram('b', [2, 7, 12, 17, 45], bins=AutoBins.from_bin_boundaries([0, 5, 10, 15, 20, 50]))
+        a.merge(b)
+        # [20, 50) in b is spread over [20, 30) and [30, 50) in a.
+        self.assertEqual([0, 10, 20, 30, 50], a.bins.get_bin_boundaries())
+        self.assertEqual([3, 3, 1, 1], a.counts)
+        self.assertEqual(8, a.get_total_count())
+
+    def test_apportion(self):
+        self.assertEqual([3, 3, 4], _apportion(10, [1, 1, 1.2]))
+        self.assertEqual([0, 7], _apportion(7, [0, 5]))
+
+    def test_serialize(self):
+        h = Histogram('latency', [1.1 ** i for i in range(100)])
+        copy = Histogram.from_bytes(h.to_bytes())
+        self.assertEqual('latency', copy.name)
+        self.assertEqual(h.counts, copy.counts)
+        self.assertEqual(h.bins.get_bin_boundaries(), copy.bins.get_bin_boundaries())
+        self.assertTrue(copy.bins.is_logarithmic())
+        self.assertEqual(str(h), str(copy))
+        self.assertEqual(h.counts, copy.merge(Histogram('empty', bins=h.bins)).counts)
+
+    def test_extend_single_value(self):
+        h = Histogram('test', [5, 5])
+        h.add(8)
+        self.assertEqual([5, 8], h.bins.get_bin_boundaries())
+        self.assertEqual([3], h.counts)
+
     def test_regress_1(self):
         # The outlier value was ending up outside the range of all of
         # the bins.
@@ -503,57 +1102,1096 @@ class TestHistogram(unittest.TestCase):
                                24, 26, 26, 24, 26, 25, 27, 35, 26, 
                                25, 27, 27, 28, 27, 28, 27, 26, 27,
                                24, 24, 25, 27, 27, 25, 24, 27, 25])
+        self.assertEqual(45, sum(h.counts))
+        self.assertEqual(1, h.counts[-1])
+
+class LogLinearHistogram(Histogram):
+
+    """
+    A histogram with LogLinearBins and array-backed counts: recording
+    a value is O(1), memory doesn't depend on the number of values,
+    and percentiles are accurate to within 10**-significant_digits
+    (relative), however spread out the values are.  (Below about
+    10**significant_digits * lowest, they're accurate to within
+    lowest.)
+
+    When printed, the bins are combined into one per power of two,
+    covering just the range that has values.
+    """
+
+    def __init__(self, name, lowest, highest, significant_digits=2, values=None):
+        Histogram.__init__(
+            self, name,
+            values=values,
+            bins=LogLinearBins(lowest, highest, significant_digits)
+            )
+
+    def _make_counts(self, bin_count):
+        return array.array('L', [0]) * bin_count
+
+    def _get_flags(self):
+        return self.LOGARITHMIC | self.LOG_LINEAR
+
+    def _get_extra_bytes(self):
+        return self.LOG_LINEAR_PARAMETERS.pack(
+            self.bins.lowest,
+            self.bins.highest,
+            self.bins.significant_digits
+            )
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Rebuilds a LogLinearHistogram from to_bytes(), with the same
+        LogLinearBins, so recording values stays O(1).
+        """
+        (magic, flags, name_length, bin_count) = cls.HEADER.unpack_from(data, 0)
+        if magic != cls.MAGIC or not (flags & cls.LOG_LINEAR):
+            raise ValueError('not a serialized LogLinearHistogram')
+        offset = cls.HEADER.size
+        name = data[offset:offset + name_length]
+        offset += name_length
+        (lowest, highest, significant_digits) = cls.LOG_LINEAR_PARAMETERS.unpack_from(data, offset)
+        offset += cls.LOG_LINEAR_PARAMETERS.size + 8 * (bin_count + 1)
+        result = cls(name, lowest, highest, significant_digits)
+        if result.bins.get_bin_count() != bin_count:
+            raise ValueError('serialized LogLinearHistogram has the wrong number of bins')
+        result.counts = array.array('L', struct.unpack_from('<%dQ' % bin_count, data, offset))
+        return result
+
+    def coarsened(self):
+        """
+        Returns an ordinary Histogram with one bin per power of two,
+        trimmed to the range that has values.
+        """
+        octaves = self.bins.get_octave_boundaries()
+        counts = [0] * (len(octaves) - 1)
+        for (low, count) in itertools.izip(self.bins.get_bin_boundaries(), self.counts):
+            if count != 0:
+                counts[bisect.bisect_right(octaves, low) - 1] += count
+        used = [i for (i, count) in enumerate(counts) if count != 0] or [0]
+        (first, last) = (used[0], used[-1])
+        bins = AutoBins.from_bin_boundaries(octaves[first:last + 2], logarithmic=True)
+        result = Histogram(self.name, bins=bins)
+        result.counts = counts[first:last + 1]
+        return result
+
+    def __str__(self):
+        return str(self.coarsened())
+
+class TestLogLinearHistogram(unittest.TestCase):
+
+    def test_percentile_error(self):
+        values = [1.07 ** i for i in xrange(300)]
+        h = LogLinearHistogram('latency', 1, 1e6, significant_digits=2)
+        for v in values[:100]:
+            h.add(v)
+        h.add_many(values[100:])
+        self.assertEqual(300, h.get_total_count())
+        self.assertTrue(1.07 ** 299 <= h.bins.get_bin_boundaries()[-1])
+        self.assertEqual('L', h.counts.typecode)
+        for p in [0, 10, 50, 90, 99, 100]:
+            exact = values[int(p / 100.0 * 299)]
+            if exact < 128:
+                self.assertTrue(abs(h.percentile(p) - exact) <= 0.5)
+            else:
+                self.assertTrue(abs(h.percentile(p) - exact) / exact < 0.01)
+
+    def test_to_bytes(self):
+        h = LogLinearHistogram('latency', 0.1, 100, values=[0.3, 5, 5, 70, 2500])
+        for decode in [LogLinearHistogram.from_bytes, Histogram.from_bytes]:
+            copy = decode(h.to_bytes())
+            self.assertTrue(isinstance(copy, LogLinearHistogram))
+            self.assertEqual('latency', copy.name)
+            self.assertEqual(h.bins.get_bin_boundaries(), copy.bins.get_bin_boundaries())
+            self.assertEqual(h.counts, copy.counts)
+            copy.add(5)
+            self.assertEqual(h.percentile(50), copy.percentile(50))
+        plain = Histogram('x', values=[1, 2, 3])
+        self.assertRaises(ValueError, LogLinearHistogram.from_bytes, plain.to_bytes())
+
+    def test_negative_values(self):
+        h = LogLinearHistogram('latency', 1, 1000)
+        counts = h.counts
+        h.add(-5)
+        h.add_many([-1, 2])
+        # The counts aren't reallocated for values that go in the
+        # first bin.
+        self.assertTrue(counts is h.counts)
+        self.assertEqual(2, h.counts[0])
+        self.assertEqual(3, h.get_total_count())
+
+    def test_str(self):
+        h = LogLinearHistogram('latency', 1, 1000, values=[3, 3, 5, 6, 7, 7, 7, 200])
+        self.assertEqual(
+            '#\n' +
+            '# Histogram of latency:\n' +
+            '#\n' +
+            '\n' +
+            '2.0\n    |**\n' +
+            '4.0\n    |*****\n' +
+            '8.0\n    |\n' +
+            '16.0\n    |\n' +
+            '32.0\n    |\n' +
+            '64.0\n    |\n' +
+            '128.0\n    |*\n' +
+            '256.0\n',
+            str(h)
+            )
 
 def is_number(x):
-    return isinstance(x, float) or isinstance(x, int)
+    # numpy's scalar types, like float32, register themselves as
+    # numbers.Real, so they count too.
+    return isinstance(x, numbers.Real)
+
+class ColumnProfile(object):
 
-def make_formatter(values):
     """
-    Returns a function that can be used to format the values in the
-    list.  Picks a reasonable number of digits of accuracy.
+    Gathers what's needed to pick a format for a column of values,
+    in one pass over them: the longest string, the biggest number,
+    and whether the numbers are all integers.  From that, it can make
+    a formatter, and say how wide the formatted values will be.
+
+    Columns held in array.arrays or numpy arrays are profiled with
+    numpy reductions instead of a loop in Python.
     """
-    # Get the ranges of the values.
-    max_string_length = 0
-    biggest_abs = 0
-    all_numbers_ints = True
-    any_numbers = False
-    for v in values:
+
+    def __init__(self, values=None):
+        self.max_string_length = 0
+        self.biggest_abs = 0
+        self.all_ints = True
+        self.any_numbers = False
+        if values is not None:
+            self.add_many(values)
+
+    def add(self, v):
         if isinstance(v, basestring):
-            max_string_length = max(max_string_length, len(v))
+            self.max_string_length = max(self.max_string_length, len(v))
         elif is_number(v):
-            any_numbers = True
-            biggest_abs = max(biggest_abs, abs(v))
+            self.any_numbers = True
+            self.biggest_abs = max(self.biggest_abs, abs(v))
             if v != int(v):
-                all_numbers_ints = False
+                self.all_ints = False
+        else:
+            self.max_string_length = max(self.max_string_length, len(str(v)))
+
+    def add_many(self, values):
+        if isinstance(values, array.array) or hasattr(values, 'dtype'):
+            values = _as_numpy_array(values)
+            if values.dtype.kind in 'iuf' and len(values) != 0:
+                self._add_numeric_array(values)
+                return
+        for v in values:
+            self.add(v)
+
+    def _add_numeric_array(self, values):
+        self.any_numbers = True
+        # Going through Python ints avoids overflow in abs() of the
+        # most negative int64.
+        biggest = max(abs(values.min().item()), abs(values.max().item()))
+        self.biggest_abs = max(self.biggest_abs, biggest)
+        if values.dtype.kind == 'f' and not numpy.all(values == numpy.floor(values)):
+            self.all_ints = False
+
+    def _get_number_size(self):
+        """
+        Returns (total_size, right_of_decimal) for numbers.
+        """
+        if self.biggest_abs < 1.0:
+            left_of_decimal = 1
+        else:
+            left_of_decimal = int(2 + math.floor(math.log10(self.biggest_abs)))
+        if self.all_ints:
+            right_of_decimal = 0
         else:
-            max_string_length = max(max_string_length, len(str(v)))
+            right_of_decimal = max(0, 5 - left_of_decimal)
+        total_size = 2 + left_of_decimal + right_of_decimal
+        return (total_size, right_of_decimal)
 
-    # Make a format string for string values
-    if any_numbers:
-        string_format = '%%%ds' % max_string_length
-    else:
-        string_format = '%%-%ds' % max_string_length
+    def get_width(self):
+        """
+        Returns the width of the values when formatted by the
+        formatter from make_formatter().
+        """
+        if self.any_numbers:
+            return max(self._get_number_size()[0], self.max_string_length)
+        else:
+            return self.max_string_length
 
-    # Make a format string for numeric values.
-    if biggest_abs < 1.0:
-        left_of_decimal = 1
-    else:
-        left_of_decimal = int(2 + math.floor(math.log10(biggest_abs)))
-    if all_numbers_ints:
-        right_of_decimal = 0
-    else:
-        right_of_decimal = max(0, 5 - left_of_decimal)
-    total_size = 2 + left_of_decimal + right_of_decimal
-    number_format = '%%%d.%df' % (total_size, right_of_decimal)
+    def get_formats(self):
+        """
+        Returns (string_format, number_format), the format strings
+        used by the formatter.  When these don't change, neither do
+        the formatted values.
+        """
+        # Make a format string for string values
+        if self.any_numbers:
+            string_format = '%%%ds' % self.max_string_length
+        else:
+            string_format = '%%-%ds' % self.max_string_length
 
-    # Make the format function
-    def formatter(v):
-        if isinstance(v, basestring):
-            return string_format % v
-        elif is_number(v):
-            return number_format % v
+        # Make a format string for numeric values.
+        number_format = '%%%d.%df' % self._get_number_size()
+
+        return (string_format, number_format)
+
+    def make_formatter(self):
+        (string_format, number_format) = self.get_formats()
+
+        # Make the format function
+        def formatter(v):
+            if isinstance(v, basestring):
+                return string_format % v
+            elif is_number(v):
+                return number_format % v
+            else:
+                return string_format % str(v)
+        return formatter
+
+def make_formatter(values):
+    """
+    Returns a function that can be used to format the values in the
+    list.  Picks a reasonable number of digits of accuracy.
+    """
+    return ColumnProfile(values).make_formatter()
+
+class TestColumnProfile(unittest.TestCase):
+
+    def test_width(self):
+        values = [1, 'abcdefgh', 123.25]
+        profile = ColumnProfile(values)
+        formatter = profile.make_formatter()
+        self.assertEqual(
+            profile.get_width(),
+            max(len(formatter(v)) for v in values)
+            )
+
+    def test_numpy_scalars(self):
+        values = [0.5, 1.25]
+        expected = [make_formatter(values)(v) for v in values]
+        for dtype in ['float32', 'float64']:
+            column = numpy.array(values, dtype=dtype)
+            formatter = make_formatter(column)
+            self.assertEqual(expected, [formatter(v) for v in column])
+        column = numpy.array([3, 70000], dtype='int32')
+        formatter = make_formatter(column)
+        expected = make_formatter([3, 70000])
+        self.assertEqual([expected(3), expected(70000)], [formatter(v) for v in column])
+
+    def test_arrays(self):
+        for values in [[3, -70000, 5], [0.5, -2.25, 100.0], [1.0, 2.0]]:
+            expected = make_formatter(values)
+            for column in [make_column(values), numpy.array(values)]:
+                profile = ColumnProfile(column)
+                self.assertEqual(ColumnProfile(values).get_width(), profile.get_width())
+                formatter = profile.make_formatter()
+                self.assertEqual(
+                    [expected(v) for v in values],
+                    [formatter(v) for v in values]
+                    )
+
+def make_column(values):
+    """
+    Returns the values in the most compact sequence that holds them
+    without changing them: an array.array of longs if they're all ints,
+    an array.array of doubles if they're all floats, and otherwise a
+    list.
+    """
+    if not isinstance(values, list):
+        values = list(values)
+    if len(values) != 0:
+        if all(type(v) is int for v in values):
+            try:
+                return array.array('l', values)
+            except OverflowError:
+                return values
+        if all(type(v) is float for v in values):
+            return array.array('d', values)
+    return values
+
+def take(column, indices):
+    """
+    Returns a new column holding the values at the given indices, in
+    the same kind of sequence as the original column.
+    """
+    if isinstance(column, array.array):
+        return array.array(column.typecode, (column[i] for i in indices))
+    if hasattr(column, 'dtype'):
+        return column[numpy.asarray(indices, dtype=int)]
+    return [column[i] for i in indices]
+
+def extend_column(column, values):
+    """
+    Appends the values to the column, and returns the column.  Typed
+    columns that can't hold the values, and numpy arrays, which can't
+    grow, are converted to a list first, so the column returned may
+    not be the one passed in.
+    """
+    if isinstance(column, array.array):
+        value_type = {'l' : int, 'd' : float}.get(column.typecode)
+        if all(type(v) is value_type for v in values):
+            try:
+                column.extend(values)
+                return column
+            except OverflowError:
+                pass
+        column = list(column)
+    elif hasattr(column, 'dtype'):
+        column = column.tolist()
+    elif not isinstance(column, list):
+        column = list(column)
+    column.extend(values)
+    return column
+
+def copy_column(column):
+    """
+    Returns a copy of a column that extend_column can change without
+    changing the original.
+    """
+    if isinstance(column, (array.array, list)):
+        return column[:]
+    return column
+
+def append_to_column(column, value):
+    """
+    Appends one value to the column, and returns the column, which
+    may be a new one.  See extend_column.
+    """
+    return extend_column(column, [value])
+
+def _round_up_to_8(n):
+    return (n + 7) & ~7
+
+class MappedStrings(object):
+
+    """
+    A read-only column of strings in a buffer, like a memory-mapped
+    file: count + 1 offsets as 64-bit integers, followed by the
+    strings themselves, end to end.  Strings are sliced out of the
+    buffer when they're asked for.
+    """
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offsets = numpy.frombuffer(buf, dtype='<i8', count=count + 1, offset=offset)
+        self.start = offset + 8 * (count + 1)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not (0 <= index < len(self)):
+            raise IndexError('index out of range')
+        (begin, end) = self.offsets[index:index + 2].tolist()
+        return self.buf[self.start + begin:self.start + end]
+
+    def __iter__(self):
+        buf = self.buf
+        start = self.start
+        offsets = self.offsets.tolist()
+        for i in xrange(len(offsets) - 1):
+            yield buf[start + offsets[i]:start + offsets[i + 1]]
+
+def encode_value(v):
+    """
+    Encodes one value for a mixed column in a saved file, as a tag
+    character followed by the value as a string.  Only plain data is
+    supported, so loading a file never runs any code from it.
+    """
+    if v is None:
+        return 'N'
+    if v is True or v is False:
+        return 'T' if v else 'F'
+    if type(v) in (int, long):
+        return 'i' + repr(v).rstrip('L')
+    if type(v) is float:
+        return 'f' + repr(v)
+    if type(v) is str:
+        return 's' + v
+    if type(v) is unicode:
+        return 'u' + v.encode('utf-8')
+    raise ValueError('cannot save a value of type %s' % type(v).__name__)
+
+def decode_value(s):
+    tag = s[:1]
+    if tag == 'N':
+        return None
+    if tag == 'T' or tag == 'F':
+        return tag == 'T'
+    if tag == 'i':
+        return int(s[1:])
+    if tag == 'f':
+        return float(s[1:])
+    if tag == 's':
+        return s[1:]
+    if tag == 'u':
+        return s[1:].decode('utf-8')
+    raise ValueError('bad value in saved column: %r' % s)
+
+class MappedValues(MappedStrings):
+
+    """
+    A read-only column of mixed values, each stored as a string by
+    encode_value, and decoded when it's asked for.
+    """
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MappedStrings.__getitem__(self, index)
+        return decode_value(MappedStrings.__getitem__(self, index))
+
+    def __iter__(self):
+        return itertools.imap(decode_value, MappedStrings.__iter__(self))
+
+class Columns(object):
+
+    """
+    Holds a table of data as one sequence per column, rather than as
+    a list of dicts.  The columns can be lists, array.arrays, or numpy
+    arrays, and must all be the same length.
+
+        Columns({ 'a' : [4, 5], 'b' : array.array('d', [8.0, 9.0]) })
+
+    Use from_rows to convert a list of dicts.  Columns can be saved
+    to a binary file with save(), and memory-mapped back with load().
+    """
+
+    def __init__(self, columns, column_names=None):
+        columns = dict(columns)
+        if column_names is None:
+            column_names = sorted(columns.keys())
+        self.column_names = list(column_names)
+        self.columns = columns
+        lengths = set(len(columns[name]) for name in self.column_names)
+        if 1 < len(lengths):
+            raise ValueError('columns have different lengths')
+        self.row_count = lengths.pop() if lengths else 0
+
+    @classmethod
+    def from_rows(cls, rows, column_names=None, default_value=None):
+        """
+        Converts a list of dicts into columns.  Values missing from a
+        row are filled in with default_value.
+        """
+        if column_names is None:
+            column_names = sorted(rows[0].keys())
+        values = [[] for name in column_names]
+        appends = [v.append for v in values]
+        for row in rows:
+            for (name, append) in itertools.izip(column_names, appends):
+                append(row.get(name, default_value))
+        return cls(
+            dict((name, make_column(v)) for (name, v) in zip(column_names, values)),
+            column_names
+            )
+
+    def __len__(self):
+        return self.row_count
+
+    def get_column_names(self):
+        return self.column_names
+
+    def get_column(self, name, default_value=None):
+        """
+        Returns the sequence of values in the named column.  If there
+        is no such column, returns a list of default_value.
+        """
+        if name in self.columns:
+            return self.columns[name]
+        return [default_value] * self.row_count
+
+    def get_row(self, index):
+        return dict((name, self.columns[name][index]) for name in self.column_names)
+
+    def iter_rows(self):
+        """
+        Generates one dict per row.
+        """
+        for values in self.iter_tuples(self.column_names):
+            yield dict(itertools.izip(self.column_names, values))
+
+    def iter_tuples(self, column_names, default_value=None):
+        """
+        Generates one tuple per row, holding the values in the given
+        columns.
+        """
+        if len(column_names) == 0:
+            return iter([()] * self.row_count)
+        return itertools.izip(*[self.get_column(name, default_value) for name in column_names])
+
+    def append(self, row, default_value=None):
+        """
+        Adds a row, given as a dict, to the end.
+        """
+        for name in self.column_names:
+            self.columns[name] = append_to_column(self.columns[name], row.get(name, default_value))
+        self.row_count += 1
+
+    def copy(self):
+        """
+        Returns new Columns that can be appended to without changing
+        these.  numpy arrays and mapped columns are shared, because
+        appending to them makes a new list anyway.
+        """
+        return Columns(
+            dict((name, copy_column(self.columns[name])) for name in self.column_names),
+            self.column_names
+            )
+
+    def take(self, indices):
+        """
+        Returns new Columns holding just the rows at the given
+        indices, in that order.
+        """
+        indices = list(indices)
+        return Columns(
+            dict((name, take(self.columns[name], indices)) for name in self.column_names),
+            self.column_names
+            )
+
+    # The binary file format, for save and load, is a header, then a
+    # description of each column, then the data for the columns, each
+    # starting on an 8-byte boundary.  Each column is one of:
+    #
+    #    l - 64-bit integers
+    #    d - doubles
+    #    s - strings, as count + 1 64-bit offsets, then the strings
+    #    v - anything else, stored like strings after encode_value
+    #
+    # There's nothing in the file that gets executed, so it's safe to
+    # load files from elsewhere.
+
+    MAGIC = 'BCF1'
+    HEADER = struct.Struct('<4sIQ')
+    COLUMN_HEADER = struct.Struct('<cHQQ')
+
+    @staticmethod
+    def _column_kind(column):
+        if isinstance(column, array.array):
+            return {'l' : 'l', 'd' : 'd'}.get(column.typecode, 'v')
+        if hasattr(column, 'dtype'):
+            return {'i' : 'l', 'f' : 'd'}.get(column.dtype.kind, 'v')
+        if isinstance(column, MappedValues):
+            return 'v'
+        if isinstance(column, MappedStrings) or all(type(v) is str for v in column):
+            return 's'
+        return 'v'
+
+    @staticmethod
+    def _column_chunks(kind, column):
+        """
+        Returns the binary form of a column, as a list of strings.
+        """
+        if kind == 'l':
+            return [_as_numpy_array(column).astype('<i8').tostring()]
+        if kind == 'd':
+            return [_as_numpy_array(column).astype('<f8').tostring()]
+        if kind == 's':
+            strings = list(column)
         else:
-            return string_format % str(v)
+            if hasattr(column, 'dtype'):
+                column = column.tolist()
+            strings = [encode_value(v) for v in column]
+        offsets = array.array('l', [0])
+        total = 0
+        for v in strings:
+            total += len(v)
+            offsets.append(total)
+        return [numpy.frombuffer(offsets, dtype='l').astype('<i8').tostring()] + strings
+
+    def save(self, path):
+        """
+        Writes the columns to a binary file that load() can map back
+        into memory without parsing it.
+        """
+        kinds = [self._column_kind(self.columns[name]) for name in self.column_names]
+        names = [
+            name.encode('utf-8') if isinstance(name, unicode) else name
+            for name in self.column_names
+            ]
+        column_data = [
+            self._column_chunks(kind, self.columns[name])
+            for (kind, name) in zip(kinds, self.column_names)
+            ]
+        header_size = self.HEADER.size + sum(
+            self.COLUMN_HEADER.size + len(name) for name in names
+            )
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(names), self.row_count))
+            offset = _round_up_to_8(header_size)
+            for (kind, name, chunks) in zip(kinds, names, column_data):
+                size = sum(len(chunk) for chunk in chunks)
+                f.write(self.COLUMN_HEADER.pack(kind, len(name), offset, size))
+                f.write(name)
+                offset = _round_up_to_8(offset + size)
+            position = header_size
+            for chunks in column_data:
+                padding = _round_up_to_8(position) - position
+                f.write('\0' * padding)
+                position += padding
+                for chunk in chunks:
+                    f.write(chunk)
+                    position += len(chunk)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Maps a file written by save() into memory.  Numeric columns
+        are numpy arrays that use the file's pages directly, so
+        nothing is read until it's used.
+
+        The file holds only data, and nothing in it is executed, so
+        files from elsewhere can be loaded safely.
+        """
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, column_count, row_count) = cls.HEADER.unpack_from(buf, 0)
+        if magic != cls.MAGIC:
+            raise ValueError('not a saved Columns file: %s' % path)
+        position = cls.HEADER.size
+        columns = {}
+        column_names = []
+        for i in xrange(column_count):
+            (kind, name_length, offset, size) = cls.COLUMN_HEADER.unpack_from(buf, position)
+            position += cls.COLUMN_HEADER.size
+            name = buf[position:position + name_length]
+            position += name_length
+            if kind == 'l':
+                column = numpy.frombuffer(buf, dtype='<i8', count=row_count, offset=offset)
+            elif kind == 'd':
+                column = numpy.frombuffer(buf, dtype='<f8', count=row_count, offset=offset)
+            elif kind == 's':
+                column = MappedStrings(buf, offset, row_count)
+            elif kind == 'v':
+                column = MappedValues(buf, offset, row_count)
+            else:
+                raise ValueError('unknown column type %r in %s' % (kind, path))
+            column_names.append(name)
+            columns[name] = column
+        return cls(columns, column_names)
+
+class TestColumns(unittest.TestCase):
+
+    def test_make_column(self):
+        self.assertEqual(array.array('l', [1, 2]), make_column([1, 2]))
+        self.assertEqual(array.array('d', [1.5, 2.0]), make_column([1.5, 2.0]))
+        self.assertEqual([1, 2.0], make_column([1, 2.0]))
+        self.assertEqual(['a', None], make_column(['a', None]))
+        self.assertEqual([True, False], make_column([True, False]))
+        self.assertEqual([1, 2 ** 70], make_column([1, 2 ** 70]))
+
+    def test_from_rows(self):
+        columns = Columns.from_rows([{ 'a' : 1, 'b' : 'x' }, { 'a' : 2 }], default_value='-')
+        self.assertEqual(['a', 'b'], columns.get_column_names())
+        self.assertEqual(2, len(columns))
+        self.assertEqual(array.array('l', [1, 2]), columns.get_column('a'))
+        self.assertEqual(['x', '-'], columns.get_column('b'))
+        self.assertEqual([None, None], columns.get_column('c'))
+        self.assertEqual({ 'a' : 2, 'b' : '-' }, columns.get_row(1))
+        self.assertEqual([(1, 'x'), (2, '-')], list(columns.iter_tuples(['a', 'b'])))
+
+    def test_take(self):
+        columns = Columns({
+            'a' : array.array('d', [1.0, 2.0, 3.0]),
+            'b' : ['x', 'y', 'z'],
+            'c' : numpy.array([7, 8, 9])
+            })
+        taken = columns.take([2, 0])
+        self.assertEqual(
+            [{ 'a' : 3.0, 'b' : 'z', 'c' : 9 }, { 'a' : 1.0, 'b' : 'x', 'c' : 7 }],
+            list(taken.iter_rows())
+            )
+        self.assertRaises(ValueError, Columns, { 'a' : [1], 'b' : [1, 2] })
+
+    def test_append(self):
+        columns = Columns({
+            'a' : array.array('l', [1]),
+            'b' : array.array('d', [2.5]),
+            'c' : numpy.array([7])
+            })
+        columns.append({ 'a' : 2, 'b' : 'x', 'c' : 8 })
+        self.assertEqual(array.array('l', [1, 2]), columns.get_column('a'))
+        self.assertEqual([2.5, 'x'], columns.get_column('b'))
+        self.assertEqual([7, 8], columns.get_column('c'))
+        self.assertEqual(2, len(columns))
+
+def parse_value(s):
+    """
+    Returns the string as an int or a float if it looks like one, and
+    otherwise returns the string.
+    """
+    try:
+        return int(s)
+    except ValueError:
+        try:
+            return float(s)
+        except ValueError:
+            return s
+
+def infer_parser(strings):
+    """
+    Returns the function to use to parse a column of strings read
+    from a CSV file: int or float if all of the strings given parse
+    that way, and otherwise None, meaning leave them as strings.
+    """
+    for parser in [int, float]:
+        try:
+            map(parser, strings)
+            return parser
+        except ValueError:
+            pass
+    return None
+
+def _reparse(column, strings):
+    """
+    Called when strings from a CSV column don't parse the way the
+    column's sample did.  Returns (parser, column, values), with the
+    parser to use from now on, the column converted if needed, and
+    the values from the strings.
+
+    An int column with floats in it becomes a float column.
+    Anything else becomes a list of ints, floats, and strings.
+    """
+    if isinstance(column, array.array) and column.typecode == 'l':
+        try:
+            values = map(float, strings)
+            return (float, array.array('d', column), values)
+        except ValueError:
+            pass
+    return (parse_value, column, map(parse_value, strings))
+
+def read_csv(f, column_names=None, sample_size=1000, chunk_size=10000, **csv_options):
+    """
+    Reads a CSV file with a header row into Columns, without making
+    a dict for each row.
+
+    The type of each column is guessed from the first sample_size
+    rows.  Columns of ints and floats are stored in arrays.  If an
+    int column has a float later in the file, it becomes a float
+    column.  If a value doesn't parse as a number at all, that column
+    falls back to a list of ints, floats, and strings.
+
+    Blank lines are skipped, and missing fields at the end of a short
+    row are read as empty strings.
+
+    Only the columns in column_names are kept, and the others are
+    never parsed.  The rows are converted chunk_size at a time, so
+    there's never more than a chunk of rows in memory.
+
+    Extra arguments are passed on to csv.reader.
+    """
+    reader = csv.reader(f, **csv_options)
+    header = next(reader)
+    if column_names is None:
+        column_names = header
+    indices = []
+    for name in column_names:
+        if name not in header:
+            raise ValueError('no column named %s' % name)
+        indices.append(header.index(name))
+
+    width = len(header)
+
+    def read_chunk(size):
+        # Returns the chunk as one list of strings per column.  Blank
+        # lines are skipped, and short rows are filled out with empty
+        # fields, like csv.DictReader does.
+        rows = []
+        for row in reader:
+            if len(row) == 0:
+                continue
+            if len(row) < width:
+                row = row + [''] * (width - len(row))
+            rows.append(row)
+            if len(rows) == size:
+                break
+        return [[row[i] for row in rows] for i in indices]
+
+    sample = read_chunk(sample_size)
+    parsers = [infer_parser(strings) for strings in sample]
+    columns = [
+        make_column(strings if parser is None else map(parser, strings))
+        for (strings, parser) in zip(sample, parsers)
+        ]
+
+    while True:
+        chunk = read_chunk(chunk_size)
+        if len(chunk) == 0 or len(chunk[0]) == 0:
+            break
+        for (i, strings) in enumerate(chunk):
+            parser = parsers[i]
+            if parser is None:
+                values = strings
+            else:
+                try:
+                    values = map(parser, strings)
+                except ValueError:
+                    (parsers[i], columns[i], values) = _reparse(columns[i], strings)
+            columns[i] = extend_column(columns[i], values)
+
+    return Columns(dict(zip(column_names, columns)), column_names)
+
+def read_json_lines(f, column_names=None, sample_size=1000, chunk_size=10000, default_value=None):
+    """
+    Reads a file with one JSON object per line into Columns.  When
+    column_names is not given, the names come from the keys of the
+    objects in the first sample_size lines.
+
+    Like read_csv, the column types come from the sample, and the
+    lines are read chunk_size at a time.
+    """
+    lines = (line for line in f if line.strip())
+
+    def read_chunk(size):
+        return [json.loads(line) for line in itertools.islice(lines, size)]
+
+    sample = read_chunk(sample_size)
+    if column_names is None:
+        column_names = sorted(set(itertools.chain.from_iterable(sample)))
+    columns = Columns.from_rows(sample, column_names, default_value).columns
+
+    while True:
+        chunk = read_chunk(chunk_size)
+        if len(chunk) == 0:
+            break
+        for name in column_names:
+            values = [row.get(name, default_value) for row in chunk]
+            columns[name] = extend_column(columns[name], values)
+
+    return Columns(columns, column_names)
+
+class TestSaveAndLoad(unittest.TestCase):
+
+    def test_save_and_load(self):
+        columns = Columns({
+            'i' : array.array('l', [1, -2, 3]),
+            'f' : numpy.array([0.5, 1.5, 2.5]),
+            's' : ['x', '', 'zzz'],
+            'm' : [1, 'two', None],
+            'v' : [True, u'caf\xe9', 2 ** 70]
+            }, ['s', 'i', 'f', 'm', 'v'])
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            columns.save(path)
+            loaded = Columns.load(path)
+            self.assertEqual(['s', 'i', 'f', 'm', 'v'], loaded.get_column_names())
+            self.assertEqual(3, len(loaded))
+            self.assertEqual(list(columns.iter_rows()), list(loaded.iter_rows()))
+            self.assertEqual('i8', loaded.get_column('i').dtype.str[1:])
+            strings = loaded.get_column('s')
+            self.assertEqual('zzz', strings[-1])
+            self.assertEqual(['x', ''], strings[:2])
+            self.assertEqual(Table(columns).csv(), Table(loaded).csv())
+            self.assertEqual(u'caf\xe9', loaded.get_column('v')[1])
+            self.assertEqual([1, 'two'], loaded.get_column('m')[:2])
+            loaded.append({ 'i' : 4, 'f' : 3.5, 's' : 'w', 'm' : 4, 'v' : None })
+            self.assertEqual(['x', '', 'zzz', 'w'], loaded.get_column('s'))
+        finally:
+            os.remove(path)
+
+    def test_not_columns(self):
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, '\0' * 100)
+        os.close(fd)
+        try:
+            self.assertRaises(ValueError, Columns.load, path)
+            self.assertRaises(ValueError, Columns({ 'a' : [object()] }).save, path)
+        finally:
+            os.remove(path)
+
+class TestReading(unittest.TestCase):
+
+    def test_read_csv(self):
+        f = StringIO.StringIO('a,b,c,d\n1,2.5,x,9\n2,3,y,9\n3.5,4,z,9\n')
+        columns = read_csv(f, column_names=['c', 'a', 'b'], sample_size=2, chunk_size=1)
+        self.assertEqual(['c', 'a', 'b'], columns.get_column_names())
+        self.assertEqual(['x', 'y', 'z'], columns.get_column('c'))
+        self.assertEqual(array.array('d', [1.0, 2.0, 3.5]), columns.get_column('a'))
+        self.assertEqual(array.array('d', [2.5, 3.0, 4.0]), columns.get_column('b'))
+        self.assertRaises(ValueError, read_csv, StringIO.StringIO('a\n'), ['b'])
+
+    def test_read_csv_fallback(self):
+        f = StringIO.StringIO('a,b\n1,2\n2,3\nx,4\n5.5,6\n')
+        columns = read_csv(f, sample_size=2, chunk_size=1)
+        self.assertEqual([1, 2, 'x', 5.5], columns.get_column('a'))
+        self.assertEqual(array.array('l', [2, 3, 4, 6]), columns.get_column('b'))
+
+    def test_read_csv_blank_and_short_rows(self):
+        f = StringIO.StringIO('a,b,c\n1,2,x\n\n\n3,4\n5,6,z\n\n')
+        columns = read_csv(f, sample_size=1, chunk_size=1)
+        self.assertEqual(3, len(columns))
+        self.assertEqual(array.array('l', [1, 3, 5]), columns.get_column('a'))
+        self.assertEqual(['x', '', 'z'], columns.get_column('c'))
+
+    def test_read_json_lines(self):
+        f = StringIO.StringIO('{"a": 1, "b": "x"}\n\n{"a": 2}\n{"a": 3.5, "b": "z"}\n')
+        columns = read_json_lines(f, sample_size=1, chunk_size=1)
+        self.assertEqual(['a', 'b'], columns.get_column_names())
+        self.assertEqual([1, 2, 3.5], columns.get_column('a'))
+        self.assertEqual([u'x', None, u'z'], columns.get_column('b'))
+
+def _index_values(column):
+    # Python values hash and compare faster than numpy scalars.
+    if hasattr(column, 'dtype'):
+        return column.tolist()
+    return column
+
+class HashIndex(object):
+
+    """
+    Maps each value in a column to the indices of the rows that hold
+    it, for finding rows with a given value without a scan.
+    """
+
+    def __init__(self, column):
+        self.rows_by_value = {}
+        for (i, v) in enumerate(_index_values(column)):
+            self.add(v, i)
+
+    def add(self, value, row_index):
+        rows = self.rows_by_value.get(value)
+        if rows is None:
+            rows = self.rows_by_value[value] = array.array('l')
+        rows.append(row_index)
+
+    def lookup(self, value):
+        """
+        Returns the indices of the rows holding the value, in order.
+        """
+        return list(self.rows_by_value.get(value, ()))
+
+    def memory_footprint(self):
+        """
+        Returns the approximate number of bytes used by the index,
+        not counting the values themselves, which are shared with the
+        column.
+        """
+        return sys.getsizeof(self.rows_by_value) + sum(
+            sys.getsizeof(rows) for rows in self.rows_by_value.itervalues()
+            )
+
+class SortedIndex(object):
+
+    """
+    Keeps the values in a column in sorted order, along with the
+    index of the row each came from, for finding the rows in a range
+    of values with a binary search.
+
+    Inserting into the middle of the sorted lists would make each add
+    take time proportional to the size of the table, so added values
+    wait in a list of pending entries and are merged in all at once
+    on the next call to range().
+    """
+
+    def __init__(self, column):
+        values = _index_values(column)
+        order = sorted(xrange(len(values)), key=values.__getitem__)
+        self.values = [values[i] for i in order]
+        self.row_indices = array.array('l', order)
+        self.pending = []
+
+    def add(self, value, row_index):
+        self.pending.append((value, row_index))
+
+    def _merge_pending(self):
+        # The existing entries and the sorted pending ones are two
+        # runs, which the (stable) sort merges in linear time.  Equal
+        # values keep the order they were added in.
+        self.pending.sort(key=operator.itemgetter(0))
+        entries = zip(self.values, self.row_indices)
+        entries.extend(self.pending)
+        entries.sort(key=operator.itemgetter(0))
+        self.values = [value for (value, _) in entries]
+        self.row_indices = array.array('l', (row_index for (_, row_index) in entries))
+        self.pending = []
+
+    def range(self, low=None, high=None):
+        """
+        Returns the indices of the rows with values from low to high,
+        inclusive, in order of value.  Either end can be None to
+        leave it open.
+        """
+        if self.pending:
+            self._merge_pending()
+        begin = 0 if low is None else bisect.bisect_left(self.values, low)
+        end = len(self.values) if high is None else bisect.bisect_right(self.values, high)
+        return self.row_indices[begin:end].tolist()
+
+    def memory_footprint(self):
+        return (
+            sys.getsizeof(self.values) +
+            sys.getsizeof(self.row_indices) +
+            sys.getsizeof(self.pending)
+            )
+
+INDEX_CLASSES = {
+    'hash' : HashIndex,
+    'sorted' : SortedIndex
+    }
+
+class TestIndexes(unittest.TestCase):
+
+    def test_hash_index(self):
+        index = HashIndex(numpy.array([3, 1, 3, 2]))
+        self.assertEqual([0, 2], index.lookup(3))
+        self.assertEqual([], index.lookup(7))
+        before = index.memory_footprint()
+        index.add(7, 4)
+        self.assertEqual([4], index.lookup(7))
+        self.assertTrue(before < index.memory_footprint())
+
+    def test_sorted_index(self):
+        index = SortedIndex(['c', 'a', 'b', 'a'])
+        self.assertEqual([1, 3, 2], index.range('a', 'b'))
+        self.assertEqual([2, 0], index.range(low='b'))
+        index.add('b', 4)
+        self.assertEqual([1, 3, 2, 4], index.range(high='bb'))
+        self.assertTrue(0 < index.memory_footprint())
+
+    def test_sorted_index_many_adds(self):
+        index = SortedIndex([5, 1])
+        for (i, v) in enumerate([3, 5, 0, 3]):
+            index.add(v, i + 2)
+        self.assertEqual(4, len(index.pending))
+        self.assertEqual([4, 1, 2, 5, 0, 3], index.range())
+        self.assertEqual([], index.pending)
+        index.add(2, 6)
+        self.assertEqual([6, 2, 5], index.range(2, 4))
+
+def sort_and_limit(items, key=None, reverse=False, offset=0, limit=None):
+    """
+    Returns a list of the items, sorted by key if there is one,
+    skipping the first offset of them and keeping at most limit.
+
+    With a limit, only the first offset + limit items are sorted,
+    using a heap, which is much faster than sorting everything when
+    the limit is small.  Like sorted(), it's stable.
+    """
+    if key is None:
+        stop = None if limit is None else offset + limit
+        return list(itertools.islice(items, offset, stop))
+    if limit is None:
+        return sorted(items, key=key, reverse=reverse)[offset:]
+    if reverse:
+        return heapq.nlargest(offset + limit, items, key=key)[offset:]
+    else:
+        return heapq.nsmallest(offset + limit, items, key=key)[offset:]
+
+def as_formatter(formatter):
+    """
+    Formatters can be given as functions or format strings.  Returns
+    a function either way.
+    """
+    if isinstance(formatter, basestring):
+        format_string = formatter
+        def format_with_string(v):
+            return format_string % v
+        return format_with_string
     return formatter
 
 class Table(object):
@@ -564,120 +2202,355 @@ class Table(object):
     The data is in the form of a list of dicts:
         [ { 'a' : 4, 'b' : 8 },
           { 'a' : 5, 'b' : 9 } ]
+
+    or a Columns object holding the same thing column by column,
+    which is much smaller for big tables.  The table is stored as
+    Columns either way.
+
+    To show just part of the table, like the top ten rows, pass a
+    limit, and optionally an offset.  Only the rows shown are kept,
+    and only they are looked at when choosing the formats.
+
+    Normally, the values are formatted each time the table is
+    output.  When the same table is output more than once, for
+    example as both text and HTML, passing a cache_size keeps up to
+    that many formatted values around to be re-used.
     """
 
     def __init__(self, data, column_names=None, sort_key=None, reverse=False,
-                 default_value=None, formatters=None, titles=None):
+                 default_value=None, formatters=None, titles=None, cache_size=0,
+                 limit=None, offset=0):
 
         if formatters is None:
             formatters = {}
-        
-        if column_names is None:
-            column_names = sorted(data[0].keys())
 
-        if sort_key is None:
-            self.data = data
+        # A Columns passed in belongs to the caller, and may be shared
+        # with other tables, so it's copied before append() changes it.
+        self._owns_columns = True
+        if isinstance(data, Columns):
+            columns = data
+            self._owns_columns = False
+            if column_names is None:
+                column_names = columns.get_column_names()
+            if sort_key is not None:
+                key_column = columns.get_column(sort_key, default_value)
+                key = key_column.__getitem__
+            else:
+                key = None
+            if key is not None or limit is not None or offset != 0:
+                order = sort_and_limit(xrange(len(columns)), key, reverse, offset, limit)
+                columns = columns.take(order)
+                self._owns_columns = True
         else:
-            self.data = sorted(data, key=(lambda item: item[sort_key]), reverse=reverse)
+            if column_names is None:
+                column_names = sorted(data[0].keys())
+            if sort_key is not None:
+                key = lambda row: row.get(sort_key, default_value)
+            else:
+                key = None
+            rows = sort_and_limit(data, key, reverse, offset, limit)
+            columns = Columns.from_rows(rows, column_names, default_value)
+
+        self.columns = columns
         self.column_names = column_names
         self.default_value = default_value
-        self.formatters = [
-            self._make_formatter(col, formatters)
-            for col in column_names
-            ]
-        
+        self.explicit_formatters = dict(
+            (name, as_formatter(f)) for (name, f) in formatters.iteritems()
+            )
+
         if titles is None:
             titles = {}
         self.column_titles = [
             titles.get(column_name, column_name)
             for column_name in column_names
             ]
-        
-        first_values = [data[0].get(col, self.default_value) for col in column_names]
-        first_row = [
-            formatter(v)
-            for (formatter, v) in zip(self.formatters, first_values)
-            ]
-        self.column_widths = [
-            max(len(col), len(val))
-            for (col, val) in zip(self.column_titles, first_row)
-            ]
 
-    def _make_formatter(self, column_name, explicit_formatters):
-        if column_name in explicit_formatters:
-            formatter = explicit_formatters[column_name]
-            if isinstance(formatter, basestring):
-                def format_string(v):
-                    return formatter % v
-                return format_string
-            else:
-                return formatter
+        # For each column, a ColumnProfile when the formatter is
+        # inferred, and the width of the widest formatted value.
+        self._profiles = [None] * len(column_names)
+        self._value_widths = [0] * len(column_names)
+        self.formatters = [None] * len(column_names)
+        self.column_widths = [0] * len(column_names)
+
+        # The cache of formatted values maps column index to a list
+        # of formatted values.  It holds at most cache_size values in
+        # all; columns that don't fit are formatted every time.
+        self.cache_size = cache_size
+        self._cache = {}
+        self._cached_count = 0
+
+        # Indexes are built the first time they're used, and are
+        # kept here by (kind, column_name).
+        self.indexes = {}
+
+        for i in xrange(len(column_names)):
+            self._update_formatter(i)
+
+    @property
+    def data(self):
+        """
+        The rows of the table, as a list of dicts.
+        """
+        return list(self.columns.iter_rows())
+
+    def _iter_rows(self):
+        """
+        Generates a tuple of values for each row, in the order of
+        self.column_names.
+        """
+        return self.columns.iter_tuples(self.column_names, self.default_value)
+
+    def save(self, path):
+        """
+        Saves the rows of the table, in order, to a binary file.  See
+        Columns.save.
+        """
+        self.columns.save(path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """
+        Makes a table from a file written by save().  The file is
+        memory-mapped, and only the columns shown are read.  Like
+        Columns.load, it never runs code from the file.  Other
+        arguments are the same as for the constructor.
+        """
+        return cls(Columns.load(path), **kwargs)
+
+    def get_index(self, column_name, kind='hash'):
+        """
+        Returns the HashIndex (kind 'hash') or SortedIndex (kind
+        'sorted') for a column, building it if this is the first time
+        it's been asked for.  Once built, it is kept up to date by
+        append().
+        """
+        key = (kind, column_name)
+        if key not in self.indexes:
+            if kind not in INDEX_CLASSES:
+                raise ValueError('unknown kind of index: %s' % kind)
+            column = self.columns.get_column(column_name, self.default_value)
+            self.indexes[key] = INDEX_CLASSES[kind](column)
+        return self.indexes[key]
+
+    def get_index_memory_footprint(self):
+        """
+        Returns the approximate number of bytes used by all of the
+        indexes built so far.
+        """
+        return sum(index.memory_footprint() for index in self.indexes.itervalues())
+
+    def _take(self, row_indices):
+        """
+        Returns a new Table, formatted like this one, holding the
+        rows at the given indices.
+        """
+        return Table(
+            self.columns.take(row_indices),
+            column_names=self.column_names,
+            default_value=self.default_value,
+            formatters=self.explicit_formatters,
+            titles=dict(zip(self.column_names, self.column_titles)),
+            cache_size=self.cache_size
+            )
+
+    def lookup(self, column_name, value):
+        """
+        Returns a Table of the rows where the column holds the value,
+        using a hash index on the column.
+        """
+        return self._take(self.get_index(column_name, 'hash').lookup(value))
+
+    def range(self, column_name, low=None, high=None):
+        """
+        Returns a Table of the rows where the column's value is from
+        low to high, inclusive, sorted by that column.  Uses a sorted
+        index on the column.
+        """
+        return self._take(self.get_index(column_name, 'sorted').range(low, high))
+
+    def query(self):
+        """
+        Returns a Query over the rows of this table.
+        """
+        return Query(self)
+
+    def group_by(self, keys, aggregations, **table_options):
+        """
+        Returns a new Table of the rows in this one, grouped and
+        aggregated.  See group_by.
+        """
+        return group_by(self, keys, aggregations, self.default_value, **table_options)
+
+    def _update_formatter(self, index):
+        """
+        Sets the formatter and width for one column.  Each value in
+        the column is looked at just once: to profile it when the
+        formatter is inferred, or to format it when the formatter is
+        given, to find the widest one.
+        """
+        column_name = self.column_names[index]
+        values = self.columns.get_column(column_name, self.default_value)
+        if column_name in self.explicit_formatters:
+            formatter = self.explicit_formatters[column_name]
+            profile = None
+            width = max(itertools.imap(len, itertools.imap(formatter, values))) if len(values) else 0
+        else:
+            profile = ColumnProfile(values)
+            formatter = profile.make_formatter()
+            width = profile.get_width()
+        self._profiles[index] = profile
+        self._value_widths[index] = width
+        self.formatters[index] = formatter
+        self.column_widths[index] = max(len(self.column_titles[index]), width)
+        self._uncache(index)
+
+    def _uncache(self, index):
+        if index in self._cache:
+            self._cached_count -= len(self._cache.pop(index))
+
+    def clear_cache(self):
+        self._cache = {}
+        self._cached_count = 0
+
+    def set_formatter(self, column_name, formatter):
+        """
+        Sets the formatter for a column, either a function or a
+        format string.  A formatter of None goes back to the inferred
+        one.
+        """
+        if formatter is None:
+            self.explicit_formatters.pop(column_name, None)
         else:
-            values = [item.get(column_name, self.default_value) 
-                      for item in self.data]
-            return make_formatter(values)
+            self.explicit_formatters[column_name] = as_formatter(formatter)
+        for (i, name) in enumerate(self.column_names):
+            if name == column_name:
+                self._update_formatter(i)
 
-    def __str__(self):
-        result = []
+    def append(self, row):
+        """
+        Adds a row, given as a dict, to the end of the table.  The
+        table is not re-sorted.
 
+        The formatters and widths are updated from just the new row.
+        Cached values are kept unless the column's format changes.
+        """
+        if not self._owns_columns:
+            self.columns = self.columns.copy()
+            self._owns_columns = True
+        self.columns.append(row, self.default_value)
+        row_index = len(self.columns) - 1
+        for ((kind, column_name), index) in self.indexes.iteritems():
+            index.add(row.get(column_name, self.default_value), row_index)
+        for (i, name) in enumerate(self.column_names):
+            v = row.get(name, self.default_value)
+            profile = self._profiles[i]
+            if profile is None:
+                cell = self.formatters[i](v)
+                self._value_widths[i] = max(self._value_widths[i], len(cell))
+            else:
+                before = profile.get_formats()
+                profile.add(v)
+                if profile.get_formats() != before:
+                    self.formatters[i] = profile.make_formatter()
+                    self._uncache(i)
+                cell = self.formatters[i](v)
+                self._value_widths[i] = profile.get_width()
+            self.column_widths[i] = max(len(self.column_titles[i]), self._value_widths[i])
+            if i in self._cache:
+                if self._cached_count < self.cache_size:
+                    self._cache[i].append(cell)
+                    self._cached_count += 1
+                else:
+                    self._uncache(i)
+
+    def _get_formatted_column(self, index):
+        """
+        Returns the formatted values in one column, from the cache if
+        they're there.  Adds them to the cache if they fit.
+        """
+        if index in self._cache:
+            return self._cache[index]
+        values = self.columns.get_column(self.column_names[index], self.default_value)
+        formatted = itertools.imap(self.formatters[index], values)
+        if self._cached_count + len(values) <= self.cache_size:
+            formatted = list(formatted)
+            self._cache[index] = formatted
+            self._cached_count += len(formatted)
+        return formatted
+
+    def _iter_formatted_rows(self):
+        """
+        Generates a tuple of formatted values for each row.
+        """
+        if len(self.column_names) == 0:
+            return iter([()] * len(self.columns))
+        return itertools.izip(*[
+            self._get_formatted_column(i) for i in xrange(len(self.column_names))
+            ])
+
+    # Each of the output formats has an iter_ method that generates
+    # the output in chunks (about one per row), and a write_ method
+    # that writes those chunks to a file.  Neither one holds more
+    # than a row of output in memory.
+
+    def iter_text(self):
         # Title row
         total_width = 1 + sum(3 + w for w in self.column_widths)
-        result.append('|')
-        result.append('=' * (total_width - 2))
-        result.append('|')
-        result.append('\n')
-        result.append('| ')
-        for (col, w) in zip(self.column_titles, self.column_widths):
-            result.append(self.pad(col, w))
-            result.append(' | ')
-        result.append('\n')
-        result.append('|')
-        result.append('-' * (total_width - 2))
-        result.append('|')
-        result.append('\n')
+        rule = '|' + '=' * (total_width - 2) + '|\n'
+        yield rule
+        yield '| ' + ''.join(
+            self.pad(col, w) + ' | '
+            for (col, w) in zip(self.column_titles, self.column_widths)
+            ) + '\n'
+        yield '|' + '-' * (total_width - 2) + '|\n'
 
         # Data rows
-        for item in self.data:
-            result.append('| ')
-            for (col, formatter, w) in zip(self.column_names, self.formatters, self.column_widths):
-                result.append(self.pad(formatter(item.get(col, self.default_value)), w))
-                result.append(' | ')
-            result.append('\n')
-        result.append('|')
-        result.append('=' * (total_width - 2))
-        result.append('|')
-        result.append('\n')
+        pad = self.pad
+        for cells in self._iter_formatted_rows():
+            yield '| ' + ''.join(
+                pad(cell, w) + ' | '
+                for (cell, w) in zip(cells, self.column_widths)
+                ) + '\n'
+        yield rule
+
+    def iter_csv(self):
+        yield ','.join(self.column_titles) + '\n'
+        for cells in self._iter_formatted_rows():
+            yield ','.join(cell.strip() for cell in cells) + '\n'
+
+    def iter_html(self):
+        yield '<table>\n'
+        yield '  <tbody>\n'
+        yield '    <tr>\n'
+        for col in self.column_titles:
+            yield '      <th>%s</th>\n' % col
+        yield '    </tr>\n'
+        for cells in self._iter_formatted_rows():
+            yield '    <tr>\n' + ''.join(
+                '      <td>%s</td>\n' % cell.strip()
+                for cell in cells
+                ) + '    </tr>\n'
+        yield '  <tbody>\n'
+        yield '</table>\n'
 
-        return ''.join(result)
+    def write_text(self, f):
+        f.writelines(self.iter_text())
+
+    def write_csv(self, f):
+        f.writelines(self.iter_csv())
+
+    def write_html(self, f):
+        f.writelines(self.iter_html())
+
+    def __str__(self):
+        return ''.join(self.iter_text())
 
     def csv(self):
-        result = []
-        result.append(','.join(self.column_titles))
-        for item in self.data:
-            result.append(','.join(
-                formatter(item.get(col, self.default_value)).strip()
-                for (col, formatter) in zip(self.column_names, self.formatters)
-                ))
-        return '\n'.join(result) + '\n'
+        return ''.join(self.iter_csv())
 
     def html(self):
-        result = []
-        result.append('<table>')
-        result.append('  <tbody>')
-        result.append('    <tr>')
-        for col in self.column_titles:
-            result.append('      <th>%s</th>' % col)
-        result.append('    </tr>')
-        for item in self.data:
-            result.append('    <tr>')
-            for (col, formatter) in zip(self.column_names, self.formatters):
-                value = formatter(item.get(col, self.default_value)).strip()
-                result.append('      <td>%s</td>' % value)
-            result.append('    </tr>')
-        result.append('  <tbody>')
-        result.append('</table>')
-        return '\n'.join(result) + '\n'
-        
+        return ''.join(self.iter_html())
+
     def pad(self, s, width):
         if len(s) < width:
             return (' ' * (width - len(s))) + s
@@ -733,6 +2606,657 @@ class TestTable(unittest.TestCase):
             table.html()
             )
 
+    def test_write(self):
+        data = [ { 'a' : i, 'b' : i * 0.5 } for i in range(100) ]
+        table = Table(data)
+        for (name, expected) in [('text', str(table)), ('csv', table.csv()), ('html', table.html())]:
+            f = StringIO.StringIO()
+            getattr(table, 'write_' + name)(f)
+            self.assertEqual(expected, f.getvalue())
+            chunks = list(getattr(table, 'iter_' + name)())
+            self.assertTrue(100 <= len(chunks))
+
+    def test_sort_and_missing_values(self):
+        data = [ { 'a' : 3, 'b' : 'x' }, { 'a' : 1 }, { 'a' : 2, 'b' : 'zz' } ]
+        table = Table(data, column_names=['b'], sort_key='a', default_value='-')
+        self.assertEqual('b\n-\nzz\nx\n', table.csv())
+        table = Table(data, sort_key='a', reverse=True, default_value='-')
+        self.assertEqual('a,b\n3,x\n2,zz\n1,-\n', table.csv())
+
+    def test_widths(self):
+        # The widths cover all of the rows, not just the first one.
+        data = [ { 'a' : 1, 'b' : 1 }, { 'a' : 'abcdefgh', 'b' : 100 } ]
+        table = Table(data, formatters={'b' : str})
+        self.assertEqual(
+            '|================|\n' +
+            '|        a |   b | \n' +
+            '|----------------|\n' +
+            '|        1 |   1 | \n' +
+            '| abcdefgh | 100 | \n' +
+            '|================|\n',
+            str(table)
+            )
+
+    def test_cache(self):
+        calls = []
+        def formatter(v):
+            calls.append(v)
+            return str(v)
+        data = [ { 'a' : i, 'b' : i * 2 } for i in range(10) ]
+        table = Table(data, formatters={'a' : formatter, 'b' : formatter}, cache_size=15)
+        del calls[:]
+        expected = str(table)
+        self.assertEqual(20, len(calls))
+        self.assertEqual(expected, str(table))
+        # One column fits in the cache, and the other doesn't.
+        self.assertEqual(30, len(calls))
+        self.assertEqual(Table(data).csv(), table.csv())
+
+    def test_set_formatter_and_append(self):
+        data = [ { 'a' : 1, 'b' : 'x' } ]
+        table = Table(data, cache_size=100)
+        self.assertEqual('a,b\n1,x\n', table.csv())
+        table.set_formatter('a', '%03d')
+        self.assertEqual('a,b\n001,x\n', table.csv())
+        table.append({ 'a' : 2, 'b' : 'long' })
+        self.assertEqual('a,b\n001,x\n002,long\n', table.csv())
+        self.assertEqual([3, 4], table.column_widths)
+        table.set_formatter('a', None)
+        table.append({ 'a' : 3.5 })
+        expected = Table(table.data)
+        self.assertEqual(str(expected), str(table))
+        self.assertEqual(expected.html(), table.html())
+
+    def test_limit(self):
+        data = [ { 'a' : i % 5, 'b' : i } for i in range(20) ]
+        table = Table(data, sort_key='a', limit=3)
+        self.assertEqual('a,b\n0,0\n0,5\n0,10\n', table.csv())
+        table = Table(data, sort_key='a', reverse=True, limit=3, offset=2)
+        self.assertEqual('a,b\n4,14\n4,19\n3,3\n', table.csv())
+        table = Table(data, limit=2, offset=18)
+        self.assertEqual('a,b\n3,18\n4,19\n', table.csv())
+        # The formats come from the rows shown
+        table = Table(data, sort_key='b', limit=2)
+        self.assertEqual([4, 4], table.column_widths)
+        columns = Columns.from_rows(data, ['a', 'b'])
+        self.assertEqual(
+            Table(data, sort_key='a', reverse=True, limit=4, offset=3).csv(),
+            Table(columns, sort_key='a', reverse=True, limit=4, offset=3).csv()
+            )
+        self.assertEqual(
+            Table(data, sort_key='a', reverse=True).csv(),
+            Table(columns, sort_key='a', reverse=True).csv()
+            )
+
+    def test_sort_and_limit(self):
+        self.assertEqual([3, 1], sort_and_limit([5, 3, 1, 4], limit=2, offset=1))
+        self.assertEqual([4, 5], sort_and_limit([5, 3, 1, 4], key=abs, limit=2, offset=2))
+        self.assertEqual([4, 3], sort_and_limit([5, 3, 1, 4], key=abs, reverse=True, offset=1, limit=2))
+        self.assertEqual([3, 4, 5], sort_and_limit([5, 3, 1, 4], key=abs, offset=1))
+
+    def test_append_to_shared_columns(self):
+        columns = Columns({ 'a' : array.array('l', [1, 2]) })
+        t1 = Table(columns)
+        t2 = Table(columns, cache_size=100)
+        expected = str(t2)
+        t1.append({ 'a' : 123456 })
+        self.assertEqual(2, len(columns))
+        self.assertEqual(expected, str(t2))
+        self.assertEqual('a\n1\n2\n123456\n', t1.csv())
+
+    def test_indexes(self):
+        data = [ { 'host' : 'h%d' % (i % 3), 'ms' : (i * 7) % 10 } for i in range(10) ]
+        table = Table(data, formatters={ 'ms' : '%03d' })
+        self.assertEqual({}, table.indexes)
+        self.assertEqual('host,ms\nh1,007\nh1,008\nh1,009\n', table.lookup('host', 'h1').csv())
+        self.assertEqual('host,ms\nh0,003\nh2,004\nh2,005\n', table.range('ms', 3, 5).csv())
+        self.assertEqual(2, len(table.indexes))
+        before = table.get_index_memory_footprint()
+        table.append({ 'host' : 'h1', 'ms' : 4 })
+        self.assertEqual('host,ms\nh1,007\nh1,008\nh1,009\nh1,004\n', table.lookup('host', 'h1').csv())
+        self.assertEqual('host,ms\nh2,004\nh1,004\n', table.range('ms', 4, 4).csv())
+        self.assertTrue(before < table.get_index_memory_footprint())
+        self.assertRaises(ValueError, table.get_index, 'ms', 'btree')
+
+    def test_columns(self):
+        columns = Columns({
+            'a' : array.array('l', [1, 3]),
+            'b' : array.array('d', [2.5, 4.0])
+            })
+        from_columns = Table(columns)
+        from_rows = Table([ { 'a' : 1, 'b' : 2.5 }, { 'a' : 3, 'b' : 4.0 } ])
+        self.assertEqual(str(from_rows), str(from_columns))
+        self.assertEqual(from_rows.csv(), from_columns.csv())
+        self.assertEqual(from_rows.data, from_columns.data)
+
+class Query(object):
+
+    """
+    A lazy pipeline over the rows of a Table, Columns, or an iterable
+    of dicts.  Each method returns a new Query with one more step:
+
+        query = Query(rows).where(lambda row: row['status'] == 500)
+        query = query.derive('kb', lambda row: row['bytes'] / 1024.0)
+        query = query.select(['host', 'kb']).sort('kb', reverse=True).limit(10)
+
+    Nothing happens until the query is output as text, CSV, or HTML,
+    or its rows are asked for.  Then the steps run together as a
+    chain of generators, so each row goes through all of them before
+    the next row is read, and no step copies the whole table.
+
+    A limit that comes after a sort is pushed into the sort, so only
+    the rows kept are ever sorted, using a heap.  Limits also move
+    ahead of derived columns, so those are only computed for the rows
+    that are kept.
+
+    Queries over an iterator, like a generator, can only be run once.
+    """
+
+    def __init__(self, source, column_names=None, default_value=None, steps=(),
+                 formatters=None, titles=None, cache_size=0):
+        if isinstance(source, Table):
+            if column_names is None:
+                column_names = source.column_names
+            if default_value is None:
+                default_value = source.default_value
+            if formatters is None:
+                formatters = source.explicit_formatters
+            if titles is None:
+                titles = dict(zip(source.column_names, source.column_titles))
+            cache_size = source.cache_size
+            source = source.columns
+        if column_names is None:
+            if isinstance(source, Columns):
+                column_names = source.get_column_names()
+            elif isinstance(source, list):
+                column_names = sorted(source[0].keys()) if source else []
+            else:
+                # Peek at the first row for the names, and put it back.
+                source = iter(source)
+                first = next(source, None)
+                if first is None:
+                    column_names = []
+                else:
+                    column_names = sorted(first.keys())
+                    source = itertools.chain([first], source)
+        self.source = source
+        self.column_names = list(column_names)
+        self.default_value = default_value
+        self.steps = tuple(steps)
+        self.formatters = dict(formatters or {})
+        self.titles = dict(titles or {})
+        self.cache_size = cache_size
+
+    def _then(self, step, column_names=None):
+        if column_names is None:
+            column_names = self.column_names
+        return Query(
+            self.source, column_names, self.default_value, self.steps + (step,),
+            self.formatters, self.titles, self.cache_size
+            )
+
+    def where(self, predicate):
+        """
+        Keeps just the rows (dicts) for which predicate returns true.
+        """
+        return self._then(('where', predicate))
+
+    def select(self, column_names):
+        """
+        Sets the columns to show, in order.  Later steps only see
+        these columns.
+        """
+        column_names = list(column_names)
+        return self._then(('select', column_names), column_names)
+
+    def derive(self, column_name, function):
+        """
+        Adds a column, computed from each row (a dict) by function.
+        """
+        column_names = self.column_names
+        if column_name not in column_names:
+            column_names = column_names + [column_name]
+        return self._then(('derive', column_name, function), column_names)
+
+    def sort(self, column_name, reverse=False):
+        return self._then(('order', column_name, reverse, 0, None))
+
+    def limit(self, limit, offset=0):
+        return self._then(('order', None, False, offset, limit))
+
+    def _plan(self):
+        """
+        Returns the steps to run, after pushing limits down and
+        merging them into sorts.  The steps are:
+
+            ('where', predicate)
+            ('select', column_names)
+            ('derive', column_name, function)
+            ('order', sort_column_or_None, reverse, offset, limit)
+        """
+        plan = []
+        for step in self.steps:
+            if step[0] == 'order' and step[1] is None:
+                (offset, limit) = step[3:]
+                # Selecting and deriving columns don't change which
+                # rows there are, so the limit can go ahead of them.
+                i = len(plan)
+                while 0 < i and plan[i - 1][0] in ('derive', 'select'):
+                    i -= 1
+                if 0 < i and plan[i - 1][0] == 'order':
+                    (kind, name, reverse, old_offset, old_limit) = plan[i - 1]
+                    if old_limit is not None:
+                        remaining = max(0, old_limit - offset)
+                        limit = remaining if limit is None else min(remaining, limit)
+                    plan[i - 1] = (kind, name, reverse, old_offset + offset, limit)
+                else:
+                    plan.insert(i, step)
+            else:
+                plan.append(step)
+        return plan
+
+    def iter_rows(self):
+        """
+        Runs the query, generating the resulting rows as dicts.
+        """
+        plan = self._plan()
+        if isinstance(self.source, Columns):
+            # When the query starts by selecting columns, the others
+            # are never read.
+            if plan and plan[0][0] == 'select':
+                rows = _project_rows(self.source, plan.pop(0)[1], self.default_value)
+            else:
+                rows = self.source.iter_rows()
+            # These dicts are made just for us, so it's safe to add
+            # derived values to them.
+            owned = True
+        else:
+            rows = iter(self.source)
+            owned = False
+        for step in plan:
+            if step[0] == 'where':
+                rows = itertools.ifilter(step[1], rows)
+            elif step[0] == 'select':
+                rows = _select_columns(rows, step[1], self.default_value)
+                owned = True
+            elif step[0] == 'derive':
+                rows = _derive_rows(rows, step[1], step[2], owned)
+                owned = True
+            else:
+                (kind, name, reverse, offset, limit) = step
+                if name is None:
+                    key = None
+                else:
+                    key = lambda row, name=name, default=self.default_value: row.get(name, default)
+                rows = _sort_and_limit_lazily(rows, key, reverse, offset, limit)
+        return rows
+
+    def to_table(self, **table_options):
+        """
+        Runs the query, and returns a Table of the results.  Options
+        are passed on to Table.  The formatters, titles, and cache
+        size of the Table the query started from are used unless the
+        options say otherwise.
+        """
+        options = {
+            'formatters' : dict(
+                (name, f) for (name, f) in self.formatters.iteritems()
+                if name in self.column_names
+                ),
+            'titles' : dict(
+                (name, t) for (name, t) in self.titles.iteritems()
+                if name in self.column_names
+                ),
+            'cache_size' : self.cache_size
+            }
+        options.update(table_options)
+        columns = Columns.from_rows(self.iter_rows(), self.column_names, self.default_value)
+        return Table(columns, default_value=self.default_value, **options)
+
+    def __str__(self):
+        return str(self.to_table())
+
+    def csv(self):
+        return self.to_table().csv()
+
+    def html(self):
+        return self.to_table().html()
+
+    def write_text(self, f):
+        self.to_table().write_text(f)
+
+    def write_csv(self, f):
+        self.to_table().write_csv(f)
+
+    def write_html(self, f):
+        self.to_table().write_html(f)
+
+def _project_rows(columns, column_names, default_value):
+    for values in columns.iter_tuples(column_names, default_value):
+        yield dict(itertools.izip(column_names, values))
+
+def _select_columns(rows, column_names, default_value):
+    for row in rows:
+        yield dict((name, row.get(name, default_value)) for name in column_names)
+
+def _derive_rows(rows, column_name, function, owned):
+    for row in rows:
+        if not owned:
+            row = dict(row)
+        row[column_name] = function(row)
+        yield row
+
+def _sort_and_limit_lazily(rows, key, reverse, offset, limit):
+    # A generator, so nothing is read until the first row is wanted.
+    for row in sort_and_limit(rows, key, reverse, offset, limit):
+        yield row
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [ { 'a' : i, 'b' : i % 3 } for i in range(10) ]
+
+    def test_query(self):
+        query = (
+            Query(self.rows)
+            .where(lambda row: row['b'] != 0)
+            .derive('c', lambda row: row['a'] * 10)
+            .select(['c', 'a'])
+            .sort('a', reverse=True)
+            .limit(3, offset=1)
+            )
+        self.assertEqual('c,a\n70,7\n50,5\n40,4\n', query.csv())
+        self.assertEqual(str(query.to_table()), str(query))
+        # The source rows are not changed.
+        self.assertEqual(set(['a', 'b']), set(self.rows[0].keys()))
+
+    def test_plan(self):
+        derive = lambda row: row['a']
+        query = Query(self.rows).sort('b').derive('c', derive).limit(5).limit(3, offset=1)
+        self.assertEqual(
+            [('order', 'b', False, 1, 3), ('derive', 'c', derive)],
+            query._plan()
+            )
+        query = Query(self.rows).limit(2).sort('a', reverse=True)
+        self.assertEqual('a,b\n1,1\n0,0\n', query.csv())
+        query = Query(self.rows).sort('a').select(['b']).limit(2)
+        self.assertEqual(
+            [('order', 'a', False, 0, 2), ('select', ['b'])],
+            query._plan()
+            )
+
+    def test_select_projects_rows(self):
+        columns = Columns.from_rows(self.rows)
+        rows = list(Query(columns).select(['b']).iter_rows())
+        self.assertEqual([{ 'b' : 0 }, { 'b' : 1 }], rows[:2])
+        query = Query(self.rows).where(lambda row: 5 < row['a']).select(['a'])
+        self.assertEqual([{ 'a' : 6 }], list(query.limit(1).iter_rows()))
+        query = query.derive('c', lambda row: len(row))
+        self.assertEqual('a,c\n6,1\n7,1\n8,1\n9,1\n', query.csv())
+
+    def test_laziness(self):
+        seen = []
+        def rows():
+            for row in self.rows:
+                seen.append(row['a'])
+                yield row
+        query = Query(rows()).limit(2)
+        self.assertEqual([0], seen)
+        self.assertEqual([0, 1], [row['a'] for row in query.iter_rows()])
+        self.assertEqual([0, 1], seen)
+
+    def test_table_query(self):
+        table = Table(Columns.from_rows(self.rows), column_names=['a'])
+        query = table.query().where(lambda row: row['b'] == 2)
+        self.assertEqual('a\n2\n5\n8\n', query.csv())
+
+    def test_table_formats(self):
+        table = Table(self.rows[:2], formatters={ 'a' : '%03d' }, titles={ 'a' : 'A' })
+        self.assertEqual('A,b\n001,1\n000,0\n', table.query().sort('a', reverse=True).csv())
+        self.assertEqual('b\n0\n1\n', table.query().select(['b']).csv())
+        self.assertEqual(
+            'a,b\n0,0\n1,1\n',
+            table.query().to_table(formatters={}, titles={}).csv()
+            )
+
+class CountAggregator(object):
+
+    """
+    Counts rows.  Like all of the aggregators, it has an add() method
+    that takes one value, and a result() method.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def result(self):
+        return self.count
+
+class SumAggregator(object):
+
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += value
+
+    def result(self):
+        return self.total
+
+class MeanAggregator(object):
+
+    def __init__(self):
+        self.moments = Moments()
+
+    def add(self, value):
+        self.moments.add(value)
+
+    def result(self):
+        if self.moments.get_count() == 0:
+            return None
+        return self.moments.mean()
+
+class MinAggregator(object):
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def result(self):
+        return self.value
+
+class MaxAggregator(object):
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or self.value < value:
+            self.value = value
+
+    def result(self):
+        return self.value
+
+class PercentileAggregator(object):
+
+    """
+    Estimates a percentile with a QuantileSketch, so the memory used
+    doesn't grow with the number of values.  Values are handed to the
+    sketch in batches, which is much faster than one at a time.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, p):
+        self.p = p
+        self.sketch = QuantileSketch()
+        self.batch = []
+
+    def add(self, value):
+        self.batch.append(value)
+        if self.BATCH_SIZE <= len(self.batch):
+            self.sketch.add_many(self.batch)
+            self.batch = []
+
+    def result(self):
+        if self.batch:
+            self.sketch.add_many(self.batch)
+            self.batch = []
+        if self.sketch.get_count() == 0:
+            return None
+        return percentile(self.sketch, self.p)
+
+AGGREGATORS = {
+    'count' : CountAggregator,
+    'sum' : SumAggregator,
+    'mean' : MeanAggregator,
+    'min' : MinAggregator,
+    'max' : MaxAggregator,
+    'percentile' : PercentileAggregator
+    }
+
+def _parse_aggregation(spec):
+    """
+    Returns (column_name, make_aggregator) for one aggregation, which
+    is 'count', or a tuple of the aggregation name, the column name,
+    and any arguments, like ('percentile', 'latency', 99).
+    """
+    if isinstance(spec, basestring):
+        spec = (spec,)
+    (name, args) = (spec[0], spec[1:])
+    if name not in AGGREGATORS:
+        raise ValueError('unknown aggregation: %s' % name)
+    if name == 'count':
+        return (None, CountAggregator)
+    if len(args) == 0:
+        raise ValueError('aggregation %s needs a column' % name)
+    column_name = args[0]
+    extra = args[1:]
+    return (column_name, lambda: AGGREGATORS[name](*extra))
+
+def group_by(data, keys, aggregations, default_value=None, **table_options):
+    """
+    Groups the rows by the values in the key columns, and returns a
+    Table with one row per group, sorted by the keys.
+
+    The data can be a Table, Columns, or any iterable of dicts, like a
+    generator reading them from a file.  The rows are looked at once,
+    and only the aggregators for each group are kept, so the memory
+    used depends on the number of groups, not the number of rows.
+
+    aggregations is a list of (output_column, aggregation) pairs:
+
+        group_by(rows, ['host'], [
+            ('requests', 'count'),
+            ('bytes', ('sum', 'bytes')),
+            ('p99', ('percentile', 'latency', 99))
+            ])
+
+    The aggregations are count, sum, mean, min, max, and percentile.
+    Values that are None are skipped by all of them except count.
+
+    Other arguments are passed on to Table.
+    """
+    if isinstance(aggregations, dict):
+        aggregations = sorted(aggregations.items())
+    keys = list(keys)
+    output_names = [name for (name, spec) in aggregations]
+    parsed = [_parse_aggregation(spec) for (name, spec) in aggregations]
+    value_names = [column_name for (column_name, make) in parsed]
+    makers = [make for (column_name, make) in parsed]
+
+    # Each row becomes a tuple of the keys and then the values.
+    needed = keys + [name for name in value_names if name is not None]
+    if isinstance(data, Table):
+        data = data.columns
+    if isinstance(data, Columns):
+        rows = data.iter_tuples(needed, default_value)
+    else:
+        rows = (tuple(row.get(name, default_value) for name in needed) for row in data)
+    key_count = len(keys)
+    value_indices = []
+    position = key_count
+    for name in value_names:
+        if name is None:
+            value_indices.append(None)
+        else:
+            value_indices.append(position)
+            position += 1
+    counted = [
+        (i, index) for (i, index) in enumerate(value_indices) if index is None
+        ]
+    valued = [
+        (i, index) for (i, index) in enumerate(value_indices) if index is not None
+        ]
+
+    groups = {}
+    for row in rows:
+        key = row[:key_count]
+        aggregators = groups.get(key)
+        if aggregators is None:
+            aggregators = groups[key] = [make() for make in makers]
+        for (i, index) in counted:
+            aggregators[i].add(None)
+        for (i, index) in valued:
+            value = row[index]
+            if value is not None:
+                aggregators[i].add(value)
+
+    column_names = keys + output_names
+    values = [[] for name in column_names]
+    for key in sorted(groups):
+        results = list(key) + [a.result() for a in groups[key]]
+        for (column, result) in zip(values, results):
+            column.append(result)
+    columns = Columns(
+        dict((name, make_column(v)) for (name, v) in zip(column_names, values)),
+        column_names
+        )
+    return Table(columns, default_value=default_value, **table_options)
+
+class TestGroupBy(unittest.TestCase):
+
+    def test_group_by(self):
+        rows = [
+            { 'host' : 'a', 'ms' : 10, 'bytes' : 100 },
+            { 'host' : 'b', 'ms' : 20, 'bytes' : 200 },
+            { 'host' : 'a', 'ms' : 30, 'bytes' : None },
+            { 'host' : 'a', 'ms' : 50, 'bytes' : 300 }
+            ]
+        aggregations = [
+            ('n', 'count'),
+            ('bytes', ('sum', 'bytes')),
+            ('mean', ('mean', 'ms')),
+            ('low', ('min', 'ms')),
+            ('high', ('max', 'ms')),
+            ('median', ('percentile', 'ms', 50))
+            ]
+        expected = [
+            { 'host' : 'a', 'n' : 3, 'bytes' : 400, 'mean' : 30.0,
+              'low' : 10, 'high' : 50, 'median' : 30.0 },
+            { 'host' : 'b', 'n' : 1, 'bytes' : 200, 'mean' : 20.0,
+              'low' : 20, 'high' : 20, 'median' : 20.0 }
+            ]
+        table = group_by(iter(rows), ['host'], aggregations)
+        self.assertEqual(['host', 'n', 'bytes', 'mean', 'low', 'high', 'median'], table.column_names)
+        self.assertEqual(expected, table.data)
+        table = Table(rows).group_by(['host'], aggregations, sort_key='n', reverse=True)
+        self.assertEqual(expected, table.data)
+        self.assertRaises(ValueError, group_by, rows, ['host'], [('x', 'mode')])
+
+    def test_percentile(self):
+        rows = Columns({ 'k' : [i % 2 for i in range(10001)], 'v' : range(10001) })
+        table = group_by(rows, ['k'], [('p90', ('percentile', 'v', 90))])
+        (even, odd) = table.columns.get_column('p90')
+        self.assertTrue(abs(even - 9000) < 200)
+        self.assertTrue(abs(odd - 9000) < 200)
+
 class Facet(object):
 
     def __init__(self, list_of_dicts, key):
@@ -0,0 +1,57 @@
+######################################################################
+#
+# File: lazy.py
+#
+# Copyright 2013 Brian Beach, All Rights Reserved.
+#
+######################################################################
+
+"""
+Importing numpy and scipy takes a noticeable fraction of a second,
+which is a lot for a short-lived script that just wants to print a
+Table.  The modules here refer to them through LazyModule, so they
+aren't imported until something actually uses them.
+"""
+
+import importlib
+import sys
+import unittest
+
+class LazyModule(object):
+
+    """
+    Stands in for a module, and imports it the first time one of its
+    attributes is used.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def is_loaded(self):
+        return self._name in sys.modules
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module %s>' % self._name
+
+numpy = LazyModule('numpy')
+scipy_special = LazyModule('scipy.special')
+scipy_stats = LazyModule('scipy.stats')
+
+class TestLazyModule(unittest.TestCase):
+
+    def test_lazy_module(self):
+        module = LazyModule('colorsys')
+        self.assertEqual((0.0, 0.0, 1.0), module.rgb_to_hsv(1.0, 1.0, 1.0))
+        self.assertTrue(module.is_loaded())
+
+if __name__ == '__main__':
+    unittest.main()